@@ -1,7 +1,13 @@
+import os
+
 MONGO_URI = 'mongodb://localhost:27017/'
 DB_NAME = 'sensorDB'
 COLLECTION_NAME = 'sensorData'
 
+# Local state files (registry snapshot with API secrets, caches, spools) live outside the source tree,
+# so they are never committed or copied into an image
+STATE_DIR = os.getenv('STATE_DIR', os.path.join(os.path.expanduser('~'), '.tuya-state'))
+
 # Device credentials
 DEVICES = {
     "Irrigation controller": "vdevo172044590691636",
@@ -26,4 +32,159 @@ FIELDS = [
 ]
 UNITS = "imperial"
 TIMESTEPS = ["current"]
-TIMEZONE = "America/New_York"
\ No newline at end of file
+TIMEZONE = "America/New_York"
+
+# Tuya cloud session pool
+TUYA_SESSION_POOL_SIZE = 32       # Max credential sets kept authenticated at once
+TUYA_TOKEN_TTL = 7200             # Tuya access tokens are valid for 2 hours
+TUYA_TOKEN_REFRESH_MARGIN = 300   # Refresh this many seconds before the token expires
+
+# /get_multi_sensor_data fan-out
+MULTI_SENSOR_CONCURRENCY = 10     # Max batch status calls (chunks of TUYA_STATUS_BATCH_SIZE devices) in parallel per request
+MULTI_SENSOR_CHUNK_TIMEOUT = 10   # Seconds before every device of a chunk is reported as timed out
+
+# Tuya batch status endpoint (/v1.0/iot-03/devices/status) accepts at most 20 device IDs
+TUYA_STATUS_BATCH_SIZE = 20
+
+# Updater poll scheduler (intervals in seconds)
+POLL_INTERVAL = 1                 # Default interval for devices without a more specific setting
+POLL_INTERVALS_BY_CATEGORY = {}   # Tuya category code -> interval, e.g. {"zwjcy": 30, "ldcg": 10}
+POLL_INTERVALS_BY_DEVICE = {}     # Device ID -> interval, overrides the category setting
+POLL_JITTER = 0.1                 # +/- fraction of the interval added to each next due time
+POLL_BATCH_WINDOW = 0.25          # Devices due within this window are polled together in one batch
+POLL_MAX_CONCURRENCY = 8          # Max batch status calls in flight
+
+# Buffered Mongo writes for MongoDBClient.insert_data
+WRITE_BUFFER_ENABLED = True
+WRITE_BUFFER_BATCH_SIZE = 500     # Flush once this many samples are pending
+WRITE_BUFFER_FLUSH_INTERVAL = 1   # ... or after this many seconds
+WRITE_BUFFER_MAX_PENDING = 10000  # Bounded queue; producers block when it is full
+WRITE_BUFFER_PUT_TIMEOUT = 5      # Seconds a producer waits for room before the sample is dropped
+WRITE_BUFFER_MAX_RETRIES = 3      # Retries of a failed insert_many before the batch is dropped
+WRITE_BUFFER_SHUTDOWN_TIMEOUT = 10  # Seconds to flush pending samples on shutdown
+WRITE_BUFFER_SPILL_PATH = os.path.join(STATE_DIR, "write_buffer_spill.jsonl")  # Samples not flushed in time, as Extended JSON
+
+# sensorData storage
+ENSURE_INDEXES = True             # Create/verify the (device_name, timestamp desc) index at startup
+USE_TIMESERIES_COLLECTION = False # Create sensorData as a MongoDB time-series collection (new deployments only)
+TIMESERIES_GRANULARITY = "seconds"
+
+# Device history queries
+HISTORY_BATCH_SIZE = 1000         # Documents per Mongo cursor round-trip when streaming
+HISTORY_PAGE_SIZE = 500           # Default page size of /device_history
+HISTORY_MAX_PAGE_SIZE = 5000
+HISTORY_PREBUCKET_FACTOR = 10     # Downsampling: Mongo first reduces a series to this many buckets per requested point
+
+# Forwarding of changed samples to the remote tuyapayload endpoint
+ENDPOINT_HOST = "dobroje.rs"
+FORWARD_SCHEME = "http"
+FORWARD_PATH = "/parametri.php?action=tuyapayload"
+FORWARD_WORKERS = 4               # Concurrent POSTs, also the keep-alive pool size
+FORWARD_QUEUE_SIZE = 10000        # Samples waiting to be sent; overflow goes to the dead-letter spool
+FORWARD_MAX_RETRIES = 4
+FORWARD_BACKOFF = 1               # Seconds before the first retry, doubled on each further retry
+FORWARD_TIMEOUT = 10
+FORWARD_SHUTDOWN_TIMEOUT = 10     # Seconds to drain the queue on shutdown
+FORWARD_DEAD_LETTER_PATH = os.path.join(STATE_DIR, "forward_dead_letters.jsonl")
+FORWARD_DEAD_LETTER_MAX_BYTES = 50 * 1024 * 1024  # Spool size past which further failed samples are dropped
+FORWARD_DEAD_LETTER_REPLAY_INTERVAL = 300  # Seconds between re-queueing the spool, 0 to only replay by hand
+FORWARD_BATCH_MODE = False        # Coalesce samples of many devices into one JSON array per request
+FORWARD_BATCH_PATH = "/parametri.php?action=tuyapayloadbatch"  # Must answer with one result per item
+FORWARD_BATCH_SIZE = 200          # Max samples per batch request
+FORWARD_BATCH_INTERVAL = 2        # Max seconds a sample waits for its batch to fill
+FORWARD_BATCH_GZIP = False        # Send batches with Content-Encoding: gzip
+
+# Per-DP change detection
+DP_DEADBANDS = {}                 # DP code -> ignored change in raw units, e.g. {"temp_current": 1} (0.1 °C at scale 1)
+DELTA_ONLY_CHANGES = False        # Store and forward only the changed DPs between keyframes
+DELTA_KEYFRAME_INTERVAL = 3600    # Seconds between full keyframe documents per device in delta mode
+
+# Adaptive polling: quiet devices back off from their interval above up to a max, changes reset it
+ADAPTIVE_POLLING = True
+POLL_BACKOFF_FACTOR = 1.5         # Interval multiplier after each poll without a change
+POLL_MAX_INTERVAL = 60            # Default upper bound of the interval
+POLL_MAX_INTERVALS_BY_CATEGORY = {}  # Tuya category code -> upper bound, e.g. {"sfkzq": 10, "zwjcy": 300}
+POLL_AFTER_COMMAND_DELAY = 1      # Seconds after a /send_command before the device is polled again
+COMMAND_EVENTS_COLLECTION = "commandEvents"
+COMMAND_EVENTS_POLL_INTERVAL = 2  # Seconds between checks for commands sent through the API
+
+# Push ingestion from the Tuya message service
+MQ_ENABLED = False
+MQ_ENV = "event"                  # "event" in production, "event-test" for the test channel
+MQ_ENDPOINTS = {
+    "cn": "wss://mqe.tuyacn.com:8285/",
+    "us": "wss://mqe.tuyaus.com:8285/",
+    "eu": "wss://mqe.tuyaeu.com:8285/",
+    "in": "wss://mqe.tuyain.com:8285/"
+}
+MQ_ACK_TIMEOUT_MS = 3000
+MQ_RECONNECT_DELAY = 5
+MQ_RECONCILE_INTERVAL = 600       # Poll interval kept as a safety net for devices that push their reports
+
+# Local LAN control via tinytuya.Device, with the cloud as fallback
+LOCAL_CONTROL_ENABLED = False
+LOCAL_DEVICES = {}                # Device ID -> {"address": "192.168.1.50" or "Auto", "version": 3.3}
+LOCAL_SOCKET_TIMEOUT = 2          # Seconds before a local call gives up and falls back to the cloud
+LOCAL_RETRY_AFTER = 60            # Seconds to stay on the cloud after a local failure
+
+# Tuya API rate limiting per (region, API key). Each process keeps its own token bucket,
+# so the limits are split evenly between the processes using the same keys.
+TUYA_RATE_LIMIT_QPS = 10          # Sustained requests per second, across all processes
+TUYA_RATE_LIMIT_BURST = 20        # Requests that may go out at once after an idle period, across all processes
+TUYA_RATE_LIMIT_PROCESSES = 2     # Processes sharing the keys: the API server and the updater
+TUYA_RATE_LIMIT_MAX_WAIT = 5      # Seconds a call may queue for a token before it fails as rate limited
+
+# Read-through status cache of the API endpoints
+STATUS_CACHE_TTL = 5              # Default max_age in seconds; 0 always reads the device live
+STATUS_CACHE_MAX_ENTRIES = 10000
+STATUS_DB_TIMEOUT = 0.5           # Seconds the poller's stored status may take to read before the device is read live
+
+# Device metadata (function specs) cache
+DEVICE_METADATA_TTL = 86400
+
+# /send_commands bulk dispatch
+BULK_COMMAND_CONCURRENCY = 10     # Max commands in flight per request
+BULK_COMMAND_DEADLINE = 30        # Default overall deadline in seconds
+
+# Async Tuya cloud client used by the API server
+TUYA_ASYNC_MAX_CONNECTIONS = 100  # Connections shared by every credential set
+TUYA_ASYNC_MAX_KEEPALIVE = 20     # Idle connections kept open for reuse
+TUYA_ASYNC_TIMEOUT = 10           # Seconds per Tuya request
+
+# Sharded updater fleet: each instance polls a consistent-hash slice of the devices
+SHARDING_ENABLED = False
+SHARD_NODES_COLLECTION = "pollerNodes"
+SHARD_HEARTBEAT_INTERVAL = 5      # Seconds between lease renewals / membership checks
+SHARD_LEASE_TTL = 15              # A node missing heartbeats for this long is considered dead
+SHARD_VNODES = 100                # Virtual nodes per instance on the hash ring
+
+# Device registry (tuyaDevicesList) refresh in the updater
+REGISTRY_REFRESH_INTERVAL = 300   # Seconds between conditional re-fetches of the device list
+REGISTRY_SNAPSHOT_PATH = os.path.join(STATE_DIR, "device_registry.json")  # Last fetched device list, used for cold starts
+REGISTRY_TIMEOUT = 10
+
+# Reactive rules, evaluated by the updater only when a DP they depend on changes (format: see src/rules.py)
+RULES_ENABLED = False
+RULES = [
+    {
+        "name": "Irrigate while the soil is warm",
+        "when": [{"device": DEVICES["Smart soil sensor"], "code": "temp_current", "op": ">", "value": 25, "hysteresis": 1}],
+        "only_if": [{"device": DEVICES["Irrigation controller"], "code": "work_state", "op": "==", "value": "auto"}],
+        "then": {"device": DEVICES["Irrigation controller"], "commands": [{"code": "switch", "value": True}]},
+        "otherwise": {"device": DEVICES["Irrigation controller"], "commands": [{"code": "switch", "value": False}]}
+    }
+]
+RULES_COMMAND_WORKERS = 4         # Threads sending rule commands, off the ingestion path
+RULES_TIMER_INTERVAL = 60         # Seconds between re-checks of rules with a time window or another shard's sensors
+
+# Shared geolocation / weather cache of TuyaDeviceManager.get_weather_data
+GEOLOCATION_TTL = 7 * 86400       # Seconds an IP -> location lookup is reused
+WEATHER_GRID_DECIMALS = 2         # Lat/lon rounding of a weather cell, 2 decimals is about 1 km
+WEATHER_TTL_BY_TIMESTEP = {       # Seconds a forecast is reused, per tomorrow.io timestep
+    "current": 300, "1m": 60, "5m": 300, "15m": 900, "30m": 1800, "1h": 3600, "1d": 21600
+}
+WEATHER_CACHE_PATH = os.path.join(STATE_DIR, "weather_cache.json")  # None keeps the cache in memory only
+
+# Prometheus-style metrics: /metrics on the API, an embedded exporter in the updater
+METRICS_ENABLED = True
+METRICS_PORT = 9100               # Port of the updater's exporter; if it is taken the updater runs without one
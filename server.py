@@ -1,22 +1,36 @@
 import os
 import sys
-from fastapi import FastAPI, HTTPException
+import asyncio
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
+from datetime import datetime
 import threading
 import time
 import requests
+import pymongo
+from bson import ObjectId
 from dotenv import load_dotenv
 import json
-import http.client
 
 # Add the project directory to the system path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # Import settings and modules from the project
 from config.settings import *
-from src.tuya_cloud_connect import TuyaDeviceManager
+from src.tuya_cloud_connect import TuyaDeviceManager, chunked
+from src.session_pool import session_pool
+from src.tuya_async_client import async_cloud
+from src.local_control import local_router
+from src.rate_limiter import rate_limiter_stats, single_flight
+from src.status_cache import status_cache
 from src.database import MongoDBClient
+from src.state_cache import last_values
+from src.forwarder import forwarder
+from src.downsample import parse_bucket, lttb
+from src.change_detection import result_to_map, map_to_result
+from src.metrics import metrics_registry, http_request_seconds, CONTENT_TYPE
 
 # Load environment variables from a .env file
 load_dotenv()
@@ -32,17 +46,75 @@ app = FastAPI(
     version="1.0.0"
 )
 
+db_client = None
+db_client_lock = threading.Lock()
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Label by route template, not the raw path, so /device_history/{device_id} stays one series
+        route = request.scope.get("route")
+        http_request_seconds.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            route=route.path if route is not None else "unmatched",
+            status=status
+        )
+
+@app.on_event("startup")
+async def open_db_client():
+    # Connecting and checking the indexes blocks, and may take long with Mongo down:
+    # do it on a worker thread without holding up startup
+    asyncio.get_running_loop().run_in_executor(None, get_db_client)
+
+@app.on_event("shutdown")
+async def close_tuya_client():
+    await async_cloud.close()
+
+def get_db_client():
+    """
+    Lazily create the shared database client used by the history endpoints.
+    Creating it blocks on Mongo, so call this from a worker thread, not the event loop.
+    """
+    global db_client
+    with db_client_lock:
+        if db_client is None:
+            db_client = MongoDBClient()
+        return db_client
+
+def record_command_event(device_id, command):
+    get_db_client().record_command_event(device_id, command)
+
+def serialize_record(record):
+    """
+    Make a sensorData document JSON serializable.
+    """
+    record = dict(record)
+    if '_id' in record:
+        record['_id'] = str(record['_id'])
+    if isinstance(record.get('timestamp'), datetime):
+        record['timestamp'] = record['timestamp'].isoformat()
+    return record
+
 class SensorDataRequest(BaseModel):
     API_REGION: str = Field(..., description="API region for Tuya", example="eu")
     API_KEY: str = Field(..., description="API key for Tuya", example="9u7uqwsp7u9pxkfmswae")
     API_SECRET: str = Field(..., description="API secret for Tuya", example="5479b5a39e464313911b4a41eb0c7355")
     DEVICE_ID: str = Field(..., description="Device ID of the Tuya device", example="vdevo172072913903404")
+    max_age: Optional[float] = Field(STATUS_CACHE_TTL, ge=0, description="Accept a cached or stored status up to this many seconds old, 0 to always read the device", example=5)
 
 class MultiSensorDataRequest(BaseModel):
     API_REGION: str = Field(..., description="API region for Tuya", example="eu")
     API_KEY: str = Field(..., description="API key for Tuya", example="9u7uqwsp7u9pxkfmswae")
     API_SECRET: str = Field(..., description="API secret for Tuya", example="5479b5a39e464313911b4a41eb0c7355")
     DEVICE_ID: List[str] = Field(..., description="Device IDs of the Tuya devices", example=["vdevo172044590691636", "vdevo172044570814122"])
+    max_age: Optional[float] = Field(STATUS_CACHE_TTL, ge=0, description="Accept a cached status up to this many seconds old, 0 to always read the devices", example=5)
 
 class CommandRequest(BaseModel):
     API_REGION: str = Field(..., description="API region for Tuya", example="eu")
@@ -58,72 +130,422 @@ class CommandRequest(BaseModel):
         ]
     })
 
+def read_stored_status(device_id, max_age):
+    """
+    The poller's latest stored status of a device, if it was stored within max_age seconds.
+    
+    Returns:
+    tuple: (status, age in seconds), or None if there is no fresh enough record.
+    Reads are bounded by STATUS_DB_TIMEOUT, so an unreachable database falls through to a live read.
+    """
+    db = db_client
+    if db is None:
+        # Still connecting, see open_db_client()
+        return None
+    with pymongo.timeout(STATUS_DB_TIMEOUT):
+        timestamp = db.get_latest_timestamp(device_id)
+        if timestamp is None:
+            return None
+        age = (datetime.now() - timestamp).total_seconds()
+        if age > max_age:
+            return None
+        status = db.get_latest_record(device_id)
+    return (status, age) if status else None
+
+class DeviceCommand(BaseModel):
+    DEVICE_ID: str = Field(..., description="Device ID of the Tuya device", example="vdevo172044590691636")
+    COMMAND: Dict[str, Any] = Field(..., description="Command to send to the Tuya device", example={"commands": [{"code": "switch", "value": True}]})
+    GROUP: int = Field(0, description="Ordering group: groups run one after another in ascending order, commands within a group run in parallel", example=0)
+
+class BulkCommandRequest(BaseModel):
+    API_REGION: str = Field(..., description="API region for Tuya", example="eu")
+    API_KEY: str = Field(..., description="API key for Tuya", example="x5xq5g4qht5pfvcakdvr")
+    API_SECRET: str = Field(..., description="API secret for Tuya", example="34f89f40acdf4de6ae23e63eef181a16")
+    COMMANDS: List[DeviceCommand] = Field([], description="Device/command pairs")
+    DEVICE_IDS: List[str] = Field([], description="Devices that all get COMMAND", example=["vdevo172044590691636"])
+    COMMAND: Optional[Dict[str, Any]] = Field(None, description="Command sent to every device in DEVICE_IDS", example={"commands": [{"code": "switch", "value": True}]})
+    DEADLINE: float = Field(BULK_COMMAND_DEADLINE, gt=0, description="Seconds for the whole request; commands not finished by then are reported as failed", example=30)
+
 @app.post("/get_sensor_data", summary="Get Sensor Data", description="Retrieve sensor data from a Tuya device")
-async def get_sensor_data(request: SensorDataRequest):
+async def get_sensor_data(request: SensorDataRequest, response: Response):
     try:
         api_region = request.API_REGION
         api_key = request.API_KEY
         api_secret = request.API_SECRET
         device_id = request.DEVICE_ID
+        credentials = (api_region, api_key, api_secret)
+
+        # Serve from memory, then from the poller's stored state, before asking Tuya.
+        # Stored records aren't keyed by credentials, so they are only served to
+        # credentials that already read this device live.
+        if request.max_age:
+            cached = status_cache.get(credentials, device_id, request.max_age)
+            source = "HIT-MEMORY"
+            if cached is None and status_cache.verified(credentials, device_id):
+                cached = await asyncio.to_thread(read_stored_status, device_id, request.max_age)
+                source = "HIT-DB"
+            if cached is not None:
+                device_status, age = cached
+                response.headers["X-Cache"] = source
+                response.headers["Age"] = str(int(age))
+                return device_status
+        response.headers["X-Cache"] = "MISS"
 
         # Initialize TuyaDeviceManager for each device
         device = TuyaDeviceManager(api_region, api_key, api_secret, device_id, '154.61.204.255')
-        if device.get_properties()['success']:
-            device_status = device.get_status()
-            if device_status:
-                return device_status
-            else:
-                raise HTTPException(status_code=404, detail="Can't get the sensors data.")
-        else:
-            raise HTTPException(status_code=500, detail="Can't connect to the device.")
+        # The status call itself tells whether the device is reachable, no separate properties check
+        device_status = await device.async_get_status()
+        if not device_status:
+            raise HTTPException(status_code=404, detail="Can't get the sensors data.")
+        if not device_status.get('success'):
+            raise HTTPException(status_code=500, detail=f"Can't connect to the device: {device_status.get('msg')}")
+        status_cache.put(credentials, device_id, device_status)
+        return device_status
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def read_status_chunk(manager, device_ids):
+    """
+    Batch status read for a chunk of devices sharing one credential set.
+    
+    Args:
+    manager: Device instance holding the credentials.
+    device_ids: IDs of the devices in the chunk.
+    
+    Returns:
+    dict: Device ID -> device status, or an error message string.
+    """
+    statuses = await manager.async_get_status_batch(device_ids)
+    for device_id, device_status in statuses.items():
+        status_cache.put(manager.credentials, device_id, device_status)
+    return {
+        device_id: statuses[device_id] if statuses.get(device_id, {}).get('success') else "Can't get the sensors data."
+        for device_id in device_ids
+    }
+
+async def fetch_status_chunk(manager, device_ids, semaphore, timeout):
+    """
+    Read one chunk, bounded by the shared semaphore and a per-chunk timeout.
+    Errors are returned as strings so one bad chunk doesn't fail the whole batch.
+    """
+    async with semaphore:
+        try:
+            return await asyncio.wait_for(read_status_chunk(manager, device_ids), timeout)
+        except asyncio.TimeoutError:
+            return {device_id: "Timed out waiting for the device." for device_id in device_ids}
+        except Exception as e:
+            return {device_id: f"Error reading the device: {e}" for device_id in device_ids}
+
 @app.post("/get_multi_sensor_data", summary="Get Sensor Data", description="Retrieve sensor data from Tuya devices")
-async def get_multi_sensor_data(request: MultiSensorDataRequest):
+async def get_multi_sensor_data(request: MultiSensorDataRequest, response: Response):
     try:
         api_region = request.API_REGION
         api_key = request.API_KEY
         api_secret = request.API_SECRET
         device_ids = request.DEVICE_ID
 
+        credentials = (api_region, api_key, api_secret)
+
+        # Devices with a fresh enough cached status aren't read again
         all_device_status = {}
+        if request.max_age:
+            for device_id in device_ids:
+                cached = status_cache.get(credentials, device_id, request.max_age)
+                if cached is not None:
+                    all_device_status[device_id] = cached[0]
+        missing = [device_id for device_id in dict.fromkeys(device_ids) if device_id not in all_device_status]
+        response.headers["X-Cache-Hits"] = str(len(device_ids) - len(missing))
 
-        for device_id in device_ids:
-            # Initialize TuyaDeviceManager for each device
-            device = TuyaDeviceManager(api_region, api_key, api_secret, device_id, '154.61.204.255')
-            if device.get_properties()['success']:
-                device_status = device.get_status()
-                if device_status:
-                    all_device_status[device_id] = device_status
-                else:
-                    all_device_status[device_id] = "Can't get the sensors data."
-            else:
-                all_device_status[device_id] = "Can't connect to the device."
+        # One batch status call per chunk, with the chunks fanned out concurrently
+        manager = TuyaDeviceManager(api_region, api_key, api_secret, device_ids[0] if device_ids else None, '154.61.204.255')
+        semaphore = asyncio.Semaphore(MULTI_SENSOR_CONCURRENCY)
+        tasks = [
+            fetch_status_chunk(manager, chunk, semaphore, MULTI_SENSOR_CHUNK_TIMEOUT)
+            for chunk in chunked(missing, TUYA_STATUS_BATCH_SIZE)
+        ]
+        for chunk_status in await asyncio.gather(*tasks):
+            all_device_status.update(chunk_status)
 
-        return all_device_status
+        return {device_id: all_device_status[device_id] for device_id in device_ids}
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
+async def optimistic_status(device, credentials, command, command_result):
+    """
+    Post-command state without another status read: the last known status with the commanded values merged in.
+    Only if no status younger than STATUS_CACHE_TTL is cached is the device read once instead.
+    
+    Args:
+    device: Device instance.
+    credentials: (api_region, api_key, api_secret) used for the command.
+    command: Command that was sent.
+    command_result: Response of the command call.
+    
+    Returns:
+    dict: Device status in the shape of get_status().
+    """
+    cached = status_cache.get(credentials, device.device_id, STATUS_CACHE_TTL)
+    if cached is None:
+        device_status = await device.async_get_status()
+        status_cache.put(credentials, device.device_id, device_status)
+        return device_status
+
+    cached_status, age = cached
+    values = result_to_map(cached_status.get('result'))
+    values.update({item['code']: item['value'] for item in command.get('commands', [])})
+    device_status = dict(cached_status, result=map_to_result(values), t=command_result.get('t'))
+    # Keep the cached status' age: the DPs that weren't commanded are no fresher than before
+    status_cache.put(credentials, device.device_id, device_status, fetched_at=time.time() - age)
+    return device_status
+
+async def execute_command(credentials, device_id, command):
+    """
+    Send one command and return the post-command status. Shared by /send_command and /send_commands.
+    
+    Args:
+    credentials: (api_region, api_key, api_secret).
+    device_id: ID of the device.
+    command: Command to send.
+    
+    Returns:
+    dict: Device status after the command.
+    """
+    # Initialize TuyaDeviceManager for each device
+    device = TuyaDeviceManager(*credentials, device_id, '154.61.204.255')
+    unknown_codes = device.unknown_command_codes(command)
+    if unknown_codes:
+        raise HTTPException(status_code=400, detail=f"Unsupported command codes: {', '.join(unknown_codes)}")
+
+    # One upstream call: its result tells whether the device was reachable
+    command_result = await device.async_send_command(command)
+    if not command_result:
+        raise HTTPException(status_code=404, detail="Can't send the command to the device.")
+
+    # Lets the updater tighten this device's poll interval. Not awaited, the response doesn't depend on Mongo.
+    asyncio.get_running_loop().run_in_executor(None, record_command_event, device_id, command)
+    return await optimistic_status(device, credentials, command, command_result)
+
 @app.post("/send_command", summary="Send Command", description="Send a command to a Tuya device")
 async def send_command(request: CommandRequest):
     try:
-        api_region = request.API_REGION
-        api_key = request.API_KEY
-        api_secret = request.API_SECRET
-        device_id = request.DEVICE_ID
-        command = request.COMMAND
+        credentials = (request.API_REGION, request.API_KEY, request.API_SECRET)
+        return await execute_command(credentials, request.DEVICE_ID, request.COMMAND)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        # Initialize TuyaDeviceManager for each device
-        device = TuyaDeviceManager(api_region, api_key, api_secret, device_id, '154.61.204.255')
-        if device.get_properties()['success']:
-            if device.send_command(command)['success']:
-                return device.get_status()
+async def dispatch_command(credentials, device_id, command, semaphore):
+    """
+    Run one command of a bulk request and turn the outcome into a result entry.
+    """
+    async with semaphore:
+        try:
+            device_status = await execute_command(credentials, device_id, command)
+            return {"success": True, "status": device_status}
+        except HTTPException as e:
+            return {"success": False, "error": e.detail}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+@app.post("/send_commands", summary="Send Commands", description="Send commands to many Tuya devices in parallel, group by group, within an overall deadline")
+async def send_commands(request: BulkCommandRequest):
+    credentials = (request.API_REGION, request.API_KEY, request.API_SECRET)
+    commands = [(item.DEVICE_ID, item.COMMAND, item.GROUP) for item in request.COMMANDS]
+    if request.DEVICE_IDS:
+        if request.COMMAND is None:
+            raise HTTPException(status_code=400, detail="COMMAND is required with DEVICE_IDS")
+        commands += [(device_id, request.COMMAND, 0) for device_id in request.DEVICE_IDS]
+    if not commands:
+        raise HTTPException(status_code=400, detail="No commands given")
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + request.DEADLINE
+    semaphore = asyncio.Semaphore(BULK_COMMAND_CONCURRENCY)
+    results = [None] * len(commands)
+
+    # Groups run in ascending order; a group only starts once the previous one has finished
+    for group in sorted({group for _, _, group in commands}):
+        indexes = [i for i, (_, _, command_group) in enumerate(commands) if command_group == group]
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            for i in indexes:
+                results[i] = {"success": False, "error": "Not sent: deadline exceeded"}
+            continue
+
+        tasks = {
+            i: asyncio.ensure_future(dispatch_command(credentials, commands[i][0], commands[i][1], semaphore))
+            for i in indexes
+        }
+        await asyncio.wait(tasks.values(), timeout=remaining)
+        for i, task in tasks.items():
+            if task.done():
+                results[i] = task.result()
             else:
-                raise HTTPException(status_code=404, detail="Can't send the command to the device.")
-        else:
-            raise HTTPException(status_code=500, detail="Can't connect to the device.")
+                # The command may still reach the device, we just stop waiting for it
+                task.cancel()
+                results[i] = {"success": False, "error": "Deadline exceeded"}
+
+    return [
+        dict(result, DEVICE_ID=device_id, GROUP=group)
+        for (device_id, _, group), result in zip(commands, results)
+    ]
+
+@app.post("/get_device_functions", summary="Get Device Functions", description="Function specs (codes, types, value ranges) of a Tuya device, cached for DEVICE_METADATA_TTL")
+async def get_device_functions(request: SensorDataRequest):
+    try:
+        device = TuyaDeviceManager(request.API_REGION, request.API_KEY, request.API_SECRET, request.DEVICE_ID)
+        functions = await device.async_get_function_specs()
+        if functions is None:
+            raise HTTPException(status_code=404, detail="Can't get the device functions.")
+        return {"device_id": request.DEVICE_ID, "functions": functions}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/metrics", summary="Metrics", description="Prometheus text exposition of the API's latency histograms, counters and queue depths")
+async def metrics():
+    return Response(metrics_registry.render(), media_type=CONTENT_TYPE)
+
+@app.get("/session_pool_stats", summary="Session Pool Stats", description="Hit, miss and token refresh counters of the shared Tuya cloud session pool and the async client")
+async def session_pool_stats():
+    return dict(session_pool.stats(), async_client=async_cloud.stats())
+
+@app.get("/rate_limiter_stats", summary="Rate Limiter Stats", description="Token bucket state per Tuya credential set and the number of coalesced duplicate requests")
+async def rate_limiter_stats_endpoint():
+    return {"limiters": rate_limiter_stats(), "coalesced": single_flight.coalesced}
+
+@app.get("/status_cache_stats", summary="Status Cache Stats", description="Hit and miss counters of the API's device status cache")
+async def status_cache_stats():
+    return status_cache.stats()
+
+@app.get("/local_routing_stats", summary="Local Routing Stats", description="Per-device counts of LAN calls, LAN failures and cloud fallbacks")
+async def local_routing_stats():
+    return local_router.stats()
+
+async def history_credentials(
+    device_id: str,
+    api_region: str = Header(..., description="API region for Tuya"),
+    api_key: str = Header(..., description="API key for Tuya"),
+    api_secret: str = Header(..., description="API secret for Tuya")
+):
+    """
+    Credentials of a history request, sent as API-REGION, API-KEY and API-SECRET headers.
+    The stored history of a device is only served to credentials that can read the device itself.
+    """
+    credentials = (api_region, api_key, api_secret)
+    if status_cache.verified(credentials, device_id):
+        return credentials
+    # Cached per credentials and device on success, so this is one Tuya call per device a day
+    device = TuyaDeviceManager(api_region, api_key, api_secret, device_id, '154.61.204.255')
+    if await device.async_get_function_specs() is None:
+        raise HTTPException(status_code=403, detail="These credentials can't access the device.")
+    return credentials
+
+def encode_history_cursor(cursor):
+    timestamp, record_id = cursor
+    return f"{timestamp.isoformat()}_{record_id}"
+
+def decode_history_cursor(value):
+    try:
+        timestamp, record_id = value.rsplit("_", 1)
+        return datetime.fromisoformat(timestamp), ObjectId(record_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor {value!r}")
+
+@app.get("/device_history/{device_id}", summary="Device History", description="Paginated history of a device, oldest first. Pass next_after from the previous page as after to continue.")
+async def device_history(
+    device_id: str,
+    start: Optional[datetime] = Query(None, description="Only records at or after this time"),
+    end: Optional[datetime] = Query(None, description="Only records at or before this time"),
+    after: Optional[str] = Query(None, description="Cursor: the next_after value of the previous page"),
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    credentials: tuple = Depends(history_credentials)
+):
+    cursor = decode_history_cursor(after) if after else None
+    try:
+        records, next_after = await asyncio.to_thread(
+            lambda: get_db_client().get_device_history_page(
+                device_id, after=cursor, limit=limit, start_date=start, end_date=end
+            )
+        )
+        return {
+            "device_id": device_id,
+            "items": [serialize_record(record) for record in records],
+            "next_after": encode_history_cursor(next_after) if next_after else None
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/device_history/{device_id}/stream", summary="Stream Device History", description="Full history of a device as newline-delimited JSON, streamed from a Mongo cursor")
+async def stream_device_history(
+    device_id: str,
+    start: Optional[datetime] = Query(None, description="Only records at or after this time"),
+    end: Optional[datetime] = Query(None, description="Only records at or before this time"),
+    credentials: tuple = Depends(history_credentials)
+):
+    # A sync generator: Starlette iterates it on a worker thread, so Mongo stays off the event loop
+    def ndjson_lines():
+        for record in get_db_client().iter_device_history(device_id, start_date=start, end_date=end):
+            yield json.dumps(serialize_record(record), default=str) + "\n"
+
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+@app.get("/device_history/{device_id}/aggregate", summary="Aggregated Device History", description="Min/max/avg/last per DP code in fixed time buckets (e.g. 1m, 1h, 1d)")
+async def aggregate_device_history(
+    device_id: str,
+    bucket: str = Query("1h", description="Bucket size: a number followed by s, m, h, d or w"),
+    start: Optional[datetime] = Query(None, description="Only records at or after this time"),
+    end: Optional[datetime] = Query(None, description="Only records at or before this time"),
+    codes: Optional[List[str]] = Query(None, description="Only these DP codes"),
+    credentials: tuple = Depends(history_credentials)
+):
+    try:
+        unit, bin_size = parse_bucket(bucket)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        aggregated = await asyncio.to_thread(
+            lambda: get_db_client().aggregate_device_history(
+                device_id, unit, bin_size, start_date=start, end_date=end, codes=codes
+            )
+        )
+        for buckets in aggregated.values():
+            for item in buckets:
+                item['timestamp'] = item['timestamp'].isoformat()
+        return {"device_id": device_id, "bucket": bucket, "codes": aggregated}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/device_history/{device_id}/downsample", summary="Downsampled Device History", description="Numeric DP series reduced to at most N points each with LTTB")
+async def downsample_device_history(
+    device_id: str,
+    points: int = Query(500, ge=3, le=HISTORY_MAX_PAGE_SIZE, description="Max points per DP code"),
+    start: Optional[datetime] = Query(None, description="Only records at or after this time"),
+    end: Optional[datetime] = Query(None, description="Only records at or before this time"),
+    codes: Optional[List[str]] = Query(None, description="Only these DP codes"),
+    credentials: tuple = Depends(history_credentials)
+):
+    try:
+        series = await asyncio.to_thread(
+            lambda: get_db_client().get_numeric_series(
+                device_id, points * HISTORY_PREBUCKET_FACTOR, start_date=start, end_date=end, codes=codes
+            )
+        )
+        return {
+            "device_id": device_id,
+            "codes": {
+                code: [
+                    {"timestamp": datetime.fromtimestamp(x).isoformat(), "value": y}
+                    for x, y in lttb(values, points)
+                ]
+                for code, values in series.items()
+            }
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -140,8 +562,10 @@ def is_data_changed(db_client, device_id, new_status):
     bool: True if data has changed, False otherwise.
     """
     try:
-        latest_record = db_client.get_latest_record(device_id)
-        return latest_record['result'] != new_status['result']
+        if device_id not in last_values:
+            # Cold miss only: steady-state polls are answered from memory
+            last_values.set(device_id, db_client.get_latest_record(device_id))
+        return last_values.has_changed(device_id, new_status)
     except Exception as e:
         print(f"Error checking data change: {e}")
         return True  # Assume data has changed if there's an error
@@ -149,36 +573,13 @@ def is_data_changed(db_client, device_id, new_status):
 def send_data_to_endpoint(device_id, data):
     """
     Send data to a specific endpoint.
+    The sample is queued and posted by the shared forwarder, so this never blocks on the network.
     
     Args:
     device_id: ID of the device.
     data: Data to be sent.
     """
-    conn = http.client.HTTPConnection("dobroje.rs")
-    
-    payload = json.dumps({
-        "deviceID": device_id,
-        "data": data
-    })
-    headers = {
-        'Content-Type': 'application/json'
-    }
-
-    try:
-        conn.request("POST", "/parametri.php?action=tuyapayload", payload, headers)
-        response = conn.getresponse()
-        
-        if response.status == 200:
-            print(f"Successfully sent data for device: {device_id}")
-        else:
-            print(f"Failed to send data for device: {device_id}, status code: {response.status}")
-            response_content = response.read().decode()
-            print(response_content)
-            
-    except Exception as e:
-        print(f"Error sending data to endpoint: {e}")
-    finally:
-        conn.close()
+    forwarder.submit(device_id, data)
 
 def database_update(db_client, device):
     """
@@ -195,6 +596,7 @@ def database_update(db_client, device):
             # Check if the luminance data has changed and update the database if it has
             if is_data_changed(db_client, device.device_id, device_status):
                 db_client.insert_data(device.device_id, device_status)
+                last_values.set(device.device_id, device_status)
                 print(f"Inserted new data for device: {device.device_id}: {device_status}")
                 send_data_to_endpoint(device.device_id, device_status)
 
@@ -207,6 +609,6 @@ def database_update(db_client, device):
 if __name__ == "__main__":
     import uvicorn
 
-    db_client = MongoDBClient()
+    db_client = get_db_client()
     
     uvicorn.run(app, host="0.0.0.0", port=8000)
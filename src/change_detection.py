@@ -0,0 +1,62 @@
+import os
+import sys
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config.settings import DP_DEADBANDS
+
+
+def result_to_map(result):
+    """
+    Turn a status 'result' list of {'code', 'value'} items into a code -> value dict.
+    """
+    return {item['code']: item['value'] for item in result or [] if 'code' in item}
+
+
+def map_to_result(values):
+    return [{'code': code, 'value': value} for code, value in values.items()]
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def value_changed(code, old, new, deadbands=DP_DEADBANDS):
+    """
+    A numeric DP with a deadband only counts as changed once it moves further than the deadband
+    from the last stored value; everything else changes on any difference.
+    """
+    deadband = deadbands.get(code)
+    if deadband is not None and is_number(old) and is_number(new):
+        return abs(new - old) > deadband
+    return old != new
+
+
+def changed_codes(previous, current, deadbands=DP_DEADBANDS):
+    """
+    Compare two code -> value dicts, ignoring DP order.
+
+    Args:
+    previous: Last stored values, or None if nothing is stored yet.
+    current: Freshly polled values.
+
+    Returns:
+    dict: code -> new value for every DP that changed (all of current if previous is None).
+    """
+    if previous is None:
+        return dict(current)
+    return {
+        code: value
+        for code, value in current.items()
+        if code not in previous or value_changed(code, previous[code], value, deadbands)
+    }
+
+
+def delta_status(status, changes):
+    """
+    Copy of a status that carries only the changed DPs, flagged so readers know to merge it.
+    """
+    delta = {key: value for key, value in status.items() if key != 'result'}
+    delta['result'] = map_to_result(changes)
+    delta['delta'] = True
+    return delta
@@ -1,12 +1,25 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError
+from bson import json_util
 from config.settings import MONGO_URI, DB_NAME, COLLECTION_NAME
+from config.settings import ENSURE_INDEXES, USE_TIMESERIES_COLLECTION, TIMESERIES_GRANULARITY
+from config.settings import HISTORY_BATCH_SIZE, HISTORY_PAGE_SIZE, COMMAND_EVENTS_COLLECTION
+from config.settings import SHARD_NODES_COLLECTION, SHARD_LEASE_TTL
+from config.settings import WRITE_BUFFER_ENABLED, WRITE_BUFFER_BATCH_SIZE, WRITE_BUFFER_FLUSH_INTERVAL
+from config.settings import WRITE_BUFFER_MAX_PENDING, WRITE_BUFFER_PUT_TIMEOUT, WRITE_BUFFER_MAX_RETRIES
+from config.settings import WRITE_BUFFER_SHUTDOWN_TIMEOUT, WRITE_BUFFER_SPILL_PATH
+from src.change_detection import result_to_map, map_to_result
+from src.metrics import mongo_read_seconds, mongo_write_seconds, queue_depth
 from datetime import datetime
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 from dotenv import load_dotenv
 import json
 import os
+import queue
 import sys
+import threading
+import time
 
 # Load environment variables from a .env file
 load_dotenv()
@@ -17,12 +30,218 @@ mongo_pass = os.getenv('mongo_pass')
 mongo_cluster = os.getenv('mongo_cluster')
 mongo_options = os.getenv('mongo_options')
 
+class BufferedWriter:
+    """
+    Write-behind buffer for sensor samples.
+
+    Samples are queued and a background thread flushes them with insert_many(ordered=False)
+    once WRITE_BUFFER_BATCH_SIZE samples are pending or WRITE_BUFFER_FLUSH_INTERVAL seconds
+    have passed. The queue is bounded: when Mongo is slow it fills up and put() blocks the
+    producer (backpressure) for up to WRITE_BUFFER_PUT_TIMEOUT before the sample is dropped.
+    On close, whatever can't be flushed within the shutdown timeout is spilled to a file.
+    """
+
+    def __init__(self, collection, batch_size=WRITE_BUFFER_BATCH_SIZE, flush_interval=WRITE_BUFFER_FLUSH_INTERVAL,
+                 max_pending=WRITE_BUFFER_MAX_PENDING, put_timeout=WRITE_BUFFER_PUT_TIMEOUT,
+                 max_retries=WRITE_BUFFER_MAX_RETRIES, spill_path=WRITE_BUFFER_SPILL_PATH):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+        self.spill_path = spill_path
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.stopping = threading.Event()
+        # Set by close(): past it, failed batches are kept for the spill file instead of retried
+        self.deadline = None
+        self.unwritten = []
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.thread = threading.Thread(target=self._run, name="mongo-writer", daemon=True)
+        self.thread.start()
+        queue_depth.set_function(self.pending, queue="write_buffer")
+
+    def put(self, document):
+        try:
+            self.queue.put(document, timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            print(f"Write buffer full, dropping sample for {document.get('device_name')}")
+            return False
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def _collect_batch(self):
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            return batch
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.stopping.is_set():
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        for attempt in range(self.max_retries + 1):
+            if attempt and self._past_deadline():
+                self.unwritten.extend(batch)
+                return
+            try:
+                with mongo_write_seconds.time(operation="insert_many"):
+                    self.collection.insert_many(batch, ordered=False)
+                self.written += len(batch)
+                return
+            except BulkWriteError as e:
+                # ordered=False: everything but the failed documents was written, don't retry those
+                failed = len(e.details.get('writeErrors', []))
+                self.written += len(batch) - failed
+                self.dropped += failed
+                print(f"Error inserting {failed} of {len(batch)} documents to MongoDB: {e}")
+                return
+            except Exception as e:
+                print(f"Error inserting data to MongoDB (attempt {attempt + 1}): {e}")
+                if attempt < self.max_retries:
+                    delay = min(2 ** attempt, 30)
+                    if self.deadline is not None:
+                        delay = min(delay, max(0, self.deadline - time.monotonic()))
+                    time.sleep(delay)
+        if self._past_deadline():
+            self.unwritten.extend(batch)
+            return
+        self.dropped += len(batch)
+
+    def _past_deadline(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def _run(self):
+        while not (self.stopping.is_set() and (self.queue.empty() or self._past_deadline())):
+            batch = self._collect_batch()
+            if batch:
+                self._write(batch)
+                self.flushes += 1
+                for _ in batch:
+                    self.queue.task_done()
+
+    def flush(self):
+        # Block until everything queued so far has been written (or dropped)
+        self.queue.join()
+
+    def close(self, timeout=WRITE_BUFFER_SHUTDOWN_TIMEOUT):
+        """
+        Flush pending samples for up to timeout seconds, then spill the rest to spill_path.
+
+        Returns:
+        int: Number of samples spilled.
+        """
+        self.deadline = time.monotonic() + timeout
+        self.stopping.set()
+        # A moment past the deadline lets a writer that just gave up hand its batch over
+        self.thread.join(timeout + 0.5)
+        if self.thread.is_alive():
+            # Stuck in an insert_many; that batch may or may not end up written
+            print("Mongo writer didn't stop in time, its in-flight batch is not spilled")
+        remaining = self.unwritten
+        while True:
+            try:
+                remaining.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if remaining:
+            self._spill(remaining)
+        return len(remaining)
+
+    def _spill(self, documents):
+        try:
+            os.makedirs(os.path.dirname(self.spill_path) or ".", mode=0o700, exist_ok=True)
+            with open(self.spill_path, "a") as spill:
+                for document in documents:
+                    spill.write(json_util.dumps(document) + "\n")
+            print(f"Spilled {len(documents)} unwritten samples to {self.spill_path}")
+        except Exception as e:
+            self.dropped += len(documents)
+            print(f"Error spilling {len(documents)} unwritten samples, dropping them: {e}")
+
+    def stats(self):
+        return {
+            "pending": self.pending(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "flushes": self.flushes
+        }
+
+
+# Serves every "latest record of a device" and per-device history query; _id breaks timestamp
+# ties so keyset pages come straight off the index, in either direction
+DEVICE_TIMESTAMP_INDEX = [("device_name", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)]
+
 class MongoDBClient:
-    def __init__(self):
+    def __init__(self, buffered=WRITE_BUFFER_ENABLED, ensure_indexes=ENSURE_INDEXES):
         uri = f"mongodb+srv://{mongo_user}:{mongo_pass}@{mongo_cluster}/{mongo_options}"        # Create a new client and connect to the server
         self.client = MongoClient(uri, server_api=ServerApi('1'))
         self.db = self.client[DB_NAME]
+        if USE_TIMESERIES_COLLECTION:
+            self.create_timeseries_collection()
         self.collection = self.db[COLLECTION_NAME]
+        if ensure_indexes:
+            self.ensure_indexes()
+        self.writer = BufferedWriter(self.collection) if buffered else None
+
+    def create_timeseries_collection(self):
+        """
+        Create COLLECTION_NAME as a MongoDB time-series collection (device_name as metaField) if it doesn't exist yet.
+        An existing regular collection is left alone; it has to be migrated by hand.
+        """
+        try:
+            if COLLECTION_NAME in self.db.list_collection_names():
+                options = self.db[COLLECTION_NAME].options()
+                if 'timeseries' not in options:
+                    print(f"{COLLECTION_NAME} already exists as a regular collection, not converting to time-series")
+                return
+            self.db.create_collection(COLLECTION_NAME, timeseries={
+                "timeField": "timestamp",
+                "metaField": "device_name",
+                "granularity": TIMESERIES_GRANULARITY
+            })
+            print(f"Created time-series collection {COLLECTION_NAME}")
+        except Exception as e:
+            print(f"Error creating time-series collection: {e}")
+
+    def ensure_indexes(self):
+        """
+        Create the (device_name, timestamp, _id) and timestamp indexes if missing and verify they exist.
+        
+        Returns:
+        bool: True if the indexes are in place.
+        """
+        try:
+            self.collection.create_index(DEVICE_TIMESTAMP_INDEX, name="device_name_timestamp_id")
+            # Superseded by device_name_timestamp_id, which serves the same queries
+            if "device_name_timestamp" in self.collection.index_information():
+                self.collection.drop_index("device_name_timestamp")
+            self.collection.create_index([("timestamp", DESCENDING)], name="timestamp")
+            # Command events are only needed for a short while to re-poll the device
+            self.db[COMMAND_EVENTS_COLLECTION].create_index("timestamp", expireAfterSeconds=3600)
+            # Liveness is checked against the lease, the TTL only cleans up long dead nodes
+            self.db[SHARD_NODES_COLLECTION].create_index("heartbeat", expireAfterSeconds=SHARD_LEASE_TTL * 10)
+
+            indexed_keys = [index['key'] for index in self.collection.index_information().values()]
+            if DEVICE_TIMESTAMP_INDEX not in [list(key) for key in indexed_keys]:
+                print(f"Index {DEVICE_TIMESTAMP_INDEX} is missing on {COLLECTION_NAME}")
+                return False
+            return True
+        except Exception as e:
+            print(f"Error ensuring MongoDB indexes: {e}")
+            return False
 
     def insert_data(self, device_name, data):
         try:
@@ -30,11 +249,16 @@ class MongoDBClient:
                 print(f"No valid data available for {device_name}. Skipping insertion.")
                 return
 
-            result = self.collection.insert_one({
+            document = {
                 "device_name": device_name,
                 "timestamp": datetime.now(),
                 "data": data
-            })
+            }
+            if self.writer is not None:
+                self.writer.put(document)
+            else:
+                with mongo_write_seconds.time(operation="insert_one"):
+                    self.collection.insert_one(document)
 
         except Exception as e:
             print(f"Error inserting data to MongoDB: {e}")
@@ -60,30 +284,335 @@ class MongoDBClient:
             print(f"Error retrieving data from MongoDB: {e}")
             return []
 
+    def iter_device_history(self, device_name=None, start_date=None, end_date=None, after=None,
+                            projection=None, batch_size=HISTORY_BATCH_SIZE, limit=0, keyset=False):
+        """
+        Stream sensor records in ascending timestamp order without materializing the cursor.
+
+        Args:
+        device_name: Only records of this device (all devices if None).
+        start_date, end_date: Optional inclusive timestamp range.
+        after: Keyset cursor (timestamp, _id), only records after it in (timestamp, _id) order.
+        keyset: Order timestamp ties by _id, as keyset pages need; implied by after.
+        projection: Mongo projection, defaults to dropping _id.
+        batch_size: Documents fetched per round-trip to Mongo.
+        limit: Max records to return, 0 for no limit.
+        """
+        query = {}
+        if device_name is not None:
+            query["device_name"] = device_name
+        timestamp = {}
+        if start_date is not None:
+            timestamp["$gte"] = start_date
+        if end_date is not None:
+            timestamp["$lte"] = end_date
+        if after is not None:
+            # Records sharing the cursor's timestamp are told apart by _id, so none are skipped
+            after_timestamp, after_id = after
+            timestamp["$gte"] = max(timestamp.get("$gte", after_timestamp), after_timestamp)
+            query["$or"] = [
+                {"timestamp": {"$gt": after_timestamp}},
+                {"timestamp": after_timestamp, "_id": {"$gt": after_id}}
+            ]
+            keyset = True
+        if timestamp:
+            query["timestamp"] = timestamp
+
+        # The _id tie-break is only needed to resume pages; a plain stream sorts on timestamp alone
+        sort = [("timestamp", ASCENDING), ("_id", ASCENDING)] if keyset else [("timestamp", ASCENDING)]
+        cursor = self.collection.find(
+            query,
+            projection if projection is not None else {"_id": 0},
+            sort=sort,
+            batch_size=batch_size,
+            limit=limit
+        )
+        try:
+            for document in cursor:
+                yield document
+        finally:
+            cursor.close()
+
+    def get_device_history_page(self, device_name, after=None, limit=HISTORY_PAGE_SIZE,
+                                start_date=None, end_date=None, projection=None):
+        """
+        One page of a device's history using (timestamp, _id) keyset pagination.
+
+        Returns:
+        tuple: (records, next_after) where next_after is the (timestamp, _id) cursor for the following page,
+        or None on the last page. The records keep their _id, a projection must not drop it.
+        """
+        try:
+            with mongo_read_seconds.time(operation="history_page"):
+                records = list(self.iter_device_history(
+                    device_name, start_date=start_date, end_date=end_date, after=after,
+                    projection=projection if projection is not None else {},
+                    batch_size=min(limit + 1, HISTORY_BATCH_SIZE), limit=limit + 1, keyset=True
+                ))
+            if len(records) > limit:
+                records = records[:limit]
+                return records, (records[-1]["timestamp"], records[-1]["_id"])
+            return records, None
+        except Exception as e:
+            print(f"Error retrieving data from MongoDB: {e}")
+            return [], None
+
+    def aggregate_device_history(self, device_name, unit, bin_size, start_date=None, end_date=None, codes=None):
+        """
+        Per DP code min/max/avg/last of a device's values in fixed time buckets, computed by Mongo.
+
+        Args:
+        device_name: ID of the device.
+        unit, bin_size: $dateTrunc bucket, e.g. ("hour", 1).
+        start_date, end_date: Optional inclusive timestamp range.
+        codes: Only these DP codes (all codes if None).
+
+        Returns:
+        dict: DP code -> list of buckets ordered by time.
+        """
+        match = {"device_name": device_name}
+        timestamp = {}
+        if start_date is not None:
+            timestamp["$gte"] = start_date
+        if end_date is not None:
+            timestamp["$lte"] = end_date
+        if timestamp:
+            match["timestamp"] = timestamp
+
+        pipeline = [
+            {"$match": match},
+            {"$sort": {"timestamp": 1}},
+            {"$project": {"_id": 0, "timestamp": 1, "result": "$data.result"}},
+            {"$unwind": "$result"}
+        ]
+        if codes:
+            pipeline.append({"$match": {"result.code": {"$in": list(codes)}}})
+        pipeline += [
+            {"$group": {
+                "_id": {
+                    "code": "$result.code",
+                    "bucket": {"$dateTrunc": {"date": "$timestamp", "unit": unit, "binSize": bin_size}}
+                },
+                # $avg ignores non-numeric values but $min/$max compare across types, so restrict them to numbers
+                "min": {"$min": {"$cond": [{"$isNumber": "$result.value"}, "$result.value", None]}},
+                "max": {"$max": {"$cond": [{"$isNumber": "$result.value"}, "$result.value", None]}},
+                "avg": {"$avg": "$result.value"},
+                "last": {"$last": "$result.value"},
+                "count": {"$sum": 1}
+            }},
+            {"$sort": {"_id.bucket": 1}}
+        ]
+
+        try:
+            aggregated = {}
+            with mongo_read_seconds.time(operation="aggregate_history"):
+                buckets = list(self.collection.aggregate(pipeline, allowDiskUse=True))
+            for bucket in buckets:
+                aggregated.setdefault(bucket["_id"]["code"], []).append({
+                    "timestamp": bucket["_id"]["bucket"],
+                    "min": bucket["min"],
+                    "max": bucket["max"],
+                    "avg": bucket["avg"],
+                    "last": bucket["last"],
+                    "count": bucket["count"]
+                })
+            return aggregated
+        except Exception as e:
+            print(f"Error aggregating data from MongoDB: {e}")
+            return {}
+
+    def get_numeric_series(self, device_name, buckets, start_date=None, end_date=None, codes=None):
+        """
+        Numeric (timestamp, value) series per DP code, pre-bucketed by Mongo so memory stays bounded:
+        the time range is cut into buckets equal slices and only the min and max point of each is returned.
+        Booleans and enums are skipped since they can't be plotted as a line.
+
+        Returns:
+        dict: DP code -> list of at most 2 * buckets (timestamp, value) pairs ordered by time.
+        """
+        try:
+            if start_date is None or end_date is None:
+                first, last = [
+                    self.collection.find_one({"device_name": device_name}, {"_id": 0, "timestamp": 1},
+                                             sort=[("timestamp", direction)])
+                    for direction in (ASCENDING, DESCENDING)
+                ]
+                if first is None:
+                    return {}
+                start_date = start_date or first["timestamp"]
+                end_date = end_date or last["timestamp"]
+            # Milliseconds per bucket, at least 1 so a single-instant range still groups
+            width = max(1, (end_date - start_date).total_seconds() * 1000 / buckets)
+
+            pipeline = [
+                {"$match": {"device_name": device_name, "timestamp": {"$gte": start_date, "$lte": end_date}}},
+                {"$project": {"_id": 0, "timestamp": 1, "result": "$data.result"}},
+                {"$unwind": "$result"},
+                # $isNumber is false for booleans
+                {"$match": {"$expr": {"$isNumber": "$result.value"}}}
+            ]
+            if codes:
+                pipeline.append({"$match": {"result.code": {"$in": list(codes)}}})
+            pipeline += [
+                {"$group": {
+                    "_id": {
+                        "code": "$result.code",
+                        "bucket": {"$floor": {"$divide": [{"$subtract": ["$timestamp", start_date]}, width]}}
+                    },
+                    # Documents compare field by field, so these are the min/max values with their timestamps
+                    "min": {"$min": {"value": "$result.value", "timestamp": "$timestamp"}},
+                    "max": {"$max": {"value": "$result.value", "timestamp": "$timestamp"}}
+                }},
+                {"$sort": {"_id.bucket": 1}}
+            ]
+            series = {}
+            with mongo_read_seconds.time(operation="numeric_series"):
+                results = list(self.collection.aggregate(pipeline, allowDiskUse=True))
+            for result in results:
+                points = sorted({
+                    (point["timestamp"].timestamp(), point["value"]) for point in (result["min"], result["max"])
+                })
+                series.setdefault(result["_id"]["code"], []).extend(points)
+            return series
+        except Exception as e:
+            print(f"Error retrieving numeric series from MongoDB: {e}")
+            return {}
+
     def get_latest_record(self, device_name):
         try:
-            result = self.collection.find_one(
-                {"device_name": device_name},
-                sort=[("timestamp", -1)]  # Sort by timestamp in descending order
-            )
+            with mongo_read_seconds.time(operation="latest_record"):
+                result = self.collection.find_one(
+                    {"device_name": device_name},
+                    sort=[("timestamp", -1)]  # Sort by timestamp in descending order
+                )
+            if result['data'].get('delta'):
+                # Delta documents only hold the changed DPs, merge them onto the last keyframe
+                return self.rebuild_latest_state(device_name)
             return result['data']
         except Exception as e:
             print(f"Error retrieving latest data from MongoDB: {e}")
             return None
+
+    def get_latest_timestamp(self, device_name):
+        """
+        Time of the latest record of a device, read from the (device_name, timestamp) index.
+        """
+        try:
+            with mongo_read_seconds.time(operation="latest_timestamp"):
+                result = self.collection.find_one(
+                    {"device_name": device_name},
+                    {"_id": 0, "timestamp": 1},
+                    sort=[("timestamp", -1)]
+                )
+            return result['timestamp'] if result else None
+        except Exception as e:
+            print(f"Error retrieving latest timestamp from MongoDB: {e}")
+            return None
+
+    def rebuild_latest_state(self, device_name):
+        """
+        Full latest status of a device stored in delta mode: the last keyframe with every later delta applied.
+        """
+        keyframe = self.collection.find_one(
+            {"device_name": device_name, "data.delta": {"$ne": True}},
+            sort=[("timestamp", -1)]
+        )
+        query = {"device_name": device_name}
+        state = {}
+        if keyframe is not None:
+            state = dict(keyframe['data'])
+            query["timestamp"] = {"$gt": keyframe["timestamp"]}
+        values = result_to_map(state.get('result'))
+
+        for document in self.collection.find(query, {"_id": 0, "data": 1}, sort=[("timestamp", 1)]):
+            values.update(result_to_map(document['data'].get('result')))
+            state.update({key: value for key, value in document['data'].items() if key not in ('result', 'delta')})
+
+        state['result'] = map_to_result(values)
+        return state
         
     def get_latest_results(self, device_name):
         try:
-            result = self.collection.find_one(
-                {"device_name": device_name},
-                sort=[("timestamp", -1)]  # Sort by timestamp in descending order
-            )
-            data = result['data']['result']
+            data = self.get_latest_record(device_name)['result']
             parsed_data = {item['code']: item['value'] for item in data}
             return parsed_data
         except Exception as e:
             print(f"Error retrieving latest data from MongoDB: {e}")
             return None
 
+    def get_latest_records(self):
+        """
+        Latest data document of every device in a single aggregate query, used to warm the last-value cache.
+        """
+        try:
+            results = self.collection.aggregate([
+                {"$sort": {"device_name": 1, "timestamp": -1}},
+                {"$group": {"_id": "$device_name", "data": {"$first": "$data"}}}
+            ], allowDiskUse=True)
+            return {result['_id']: result['data'] for result in results}
+        except Exception as e:
+            print(f"Error retrieving latest records from MongoDB: {e}")
+            return {}
+
+    def record_command_event(self, device_name, command):
+        """
+        Note that a command was sent to a device, so the updater can poll it again sooner.
+        """
+        try:
+            with mongo_write_seconds.time(operation="command_event"):
+                self.db[COMMAND_EVENTS_COLLECTION].insert_one({
+                    "device_name": device_name,
+                    "timestamp": datetime.now(),
+                    "command": command
+                })
+        except Exception as e:
+            print(f"Error recording command event to MongoDB: {e}")
+
+    def get_command_events(self, since):
+        try:
+            with mongo_read_seconds.time(operation="command_events"):
+                results = self.db[COMMAND_EVENTS_COLLECTION].find(
+                    {"timestamp": {"$gt": since}},
+                    {"_id": 0, "device_name": 1, "timestamp": 1},
+                    sort=[("timestamp", ASCENDING)]
+                )
+                return list(results)
+        except Exception as e:
+            print(f"Error retrieving command events from MongoDB: {e}")
+            return []
+
+    def heartbeat_node(self, node_id, lease_ttl):
+        """
+        Renew a poller node's lease and list the nodes whose lease is still valid.
+        Both the heartbeat and the liveness check use the server's clock, so node clocks don't have to agree.
+        
+        Returns:
+        list: IDs of the live nodes, or None if Mongo couldn't be reached.
+        """
+        try:
+            nodes = self.db[SHARD_NODES_COLLECTION]
+            nodes.update_one(
+                {"_id": node_id},
+                {"$currentDate": {"heartbeat": True}, "$setOnInsert": {"started_at": datetime.now()}},
+                upsert=True
+            )
+            live = nodes.find(
+                {"$expr": {"$gte": ["$heartbeat", {"$subtract": ["$$NOW", lease_ttl * 1000]}]}},
+                {"_id": 1}
+            )
+            return [node["_id"] for node in live]
+        except Exception as e:
+            print(f"Error renewing poller lease in MongoDB: {e}")
+            return None
+
+    def remove_node(self, node_id):
+        try:
+            self.db[SHARD_NODES_COLLECTION].delete_one({"_id": node_id})
+        except Exception as e:
+            print(f"Error removing poller node from MongoDB: {e}")
 
     def close(self):
+        # Flush buffered samples before the connection goes away
+        if self.writer is not None:
+            self.writer.close()
         self.client.close()
@@ -0,0 +1,136 @@
+import hashlib
+import json
+
+import requests
+
+import sys
+import os
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config.settings import REGISTRY_SNAPSHOT_PATH, REGISTRY_TIMEOUT
+
+
+def parse_devices(devices_data):
+    """
+    Flatten the tuyaDevicesList response.
+
+    Returns:
+    dict: Device ID -> ((api_region, api_key, api_secret), device name).
+    """
+    devices = {}
+    for project in devices_data.get("projects", []):
+        credentials = (project.get("api_region"), project.get("api_key"), project.get("api_secret"))
+        for device_name, device_id in project.get("devices", {}).items():
+            devices[device_id] = (credentials, device_name)
+    return devices
+
+
+def parse_projects(devices_data):
+    return [
+        (project.get("api_region"), project.get("api_key"), project.get("api_secret"))
+        for project in devices_data.get("projects", [])
+    ]
+
+
+def diff_devices(current, new):
+    """
+    Compare two device ID -> credentials maps. A device that moved to other credentials is both removed and added.
+
+    Returns:
+    tuple: (added device IDs, removed device IDs).
+    """
+    added = [device_id for device_id, credentials in new.items() if current.get(device_id) != credentials]
+    removed = [device_id for device_id, credentials in current.items() if new.get(device_id) != credentials]
+    return added, removed
+
+
+class DeviceRegistry:
+    """
+    The remote device list (projects, credentials and device IDs), fetched with conditional
+    requests. ETag / Last-Modified are sent back so an unchanged list costs a 304; servers
+    that ignore them are caught by comparing a hash of the body. Every new version is also
+    written to a local snapshot so a restart can begin polling without waiting for the remote.
+    """
+
+    def __init__(self, url, snapshot_path=REGISTRY_SNAPSHOT_PATH, timeout=REGISTRY_TIMEOUT):
+        self.url = url
+        self.snapshot_path = snapshot_path
+        self.timeout = timeout
+        self.etag = None
+        self.last_modified = None
+        self.content_hash = None
+        self.fetches = 0
+        self.not_modified = 0
+
+    def load_snapshot(self):
+        """
+        The device list from the local snapshot, or None if there is none.
+        Its validators are reused, so the next fetch is conditional as well.
+        """
+        try:
+            with open(self.snapshot_path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Error reading device registry snapshot: {e}")
+            return None
+        self.etag = snapshot.get("etag")
+        self.last_modified = snapshot.get("last_modified")
+        self.content_hash = snapshot.get("hash")
+        return snapshot.get("data")
+
+    def _save_snapshot(self, devices_data):
+        snapshot = {
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "hash": self.content_hash,
+            "data": devices_data
+        }
+        # Write then rename so a crash never leaves a truncated snapshot; it holds API secrets, so owner-only
+        temp_path = f"{self.snapshot_path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_path) or ".", mode=0o700, exist_ok=True)
+            with open(temp_path, "w") as snapshot_file:
+                json.dump(snapshot, snapshot_file)
+            os.chmod(temp_path, 0o600)
+            os.replace(temp_path, self.snapshot_path)
+        except Exception as e:
+            print(f"Error writing device registry snapshot: {e}")
+
+    def fetch(self):
+        """
+        Fetch the device list if it changed since the last fetch.
+
+        Returns:
+        dict: The new device list, or None if it is unchanged.
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+
+        self.fetches += 1
+        response = requests.get(self.url, headers=headers, timeout=self.timeout)
+        if response.status_code == 304:
+            self.not_modified += 1
+            return None
+        if response.status_code != 200:
+            raise ConnectionError(f"Failed to fetch devices: status code {response.status_code}")
+
+        content_hash = hashlib.blake2b(response.content, digest_size=16).hexdigest()
+        self.etag = response.headers.get("ETag")
+        self.last_modified = response.headers.get("Last-Modified")
+        if content_hash == self.content_hash:
+            self.not_modified += 1
+            return None
+
+        devices_data = response.json()
+        self.content_hash = content_hash
+        self._save_snapshot(devices_data)
+        return devices_data
+
+    def stats(self):
+        return {"fetches": self.fetches, "not_modified": self.not_modified, "etag": self.etag}
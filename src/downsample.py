@@ -0,0 +1,67 @@
+import re
+
+# Supported aggregation bucket units, e.g. "1m", "15m", "1h", "1d"
+BUCKET_UNITS = {
+    "s": "second",
+    "m": "minute",
+    "h": "hour",
+    "d": "day",
+    "w": "week"
+}
+
+
+def parse_bucket(bucket):
+    """
+    Parse a bucket size like "5m" or "1h" into a ($dateTrunc unit, binSize) pair.
+    """
+    match = re.fullmatch(r"(\d+)([smhdw])", bucket or "")
+    if not match or int(match.group(1)) < 1:
+        raise ValueError(f"Invalid bucket '{bucket}', expected e.g. 1m, 1h or 1d")
+    return BUCKET_UNITS[match.group(2)], int(match.group(1))
+
+
+def lttb(points, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling.
+
+    Args:
+    points: List of (x, y) pairs sorted by x, both numeric.
+    threshold: Number of points to keep.
+
+    Returns:
+    list: At most threshold points that preserve the visual shape of the series.
+    """
+    if threshold >= len(points):
+        return list(points)
+    if threshold < 3:
+        return [points[0], points[-1]][:threshold]
+
+    sampled = [points[0]]
+    every = (len(points) - 2) / (threshold - 2)
+    a = 0
+
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third vertex of the triangle
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, len(points))
+        next_bucket = points[next_start:next_end]
+        avg_x = sum(p[0] for p in next_bucket) / len(next_bucket)
+        avg_y = sum(p[1] for p in next_bucket) / len(next_bucket)
+
+        # Pick the point of the current bucket forming the largest triangle with the previous pick
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        ax, ay = points[a]
+        max_area = -1
+        max_index = start
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (points[j][1] - ay) - (ax - points[j][0]) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                max_index = j
+
+        sampled.append(points[max_index])
+        a = max_index
+
+    sampled.append(points[-1])
+    return sampled
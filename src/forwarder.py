@@ -0,0 +1,396 @@
+import gzip
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config.settings import *
+from src.metrics import forward_seconds, forward_results, queue_depth
+
+
+def is_acknowledged(result):
+    if isinstance(result, bool):
+        return result
+    if isinstance(result, dict):
+        if 'success' in result:
+            return bool(result['success'])
+        return str(result.get('status', 'ok')).lower() in ('ok', 'success', '200')
+    return True
+
+
+class EndpointForwarder:
+    """
+    Forwards changed samples to the remote tuyapayload endpoint off the polling path.
+
+    submit() only enqueues; a small pool of worker threads posts the samples over a
+    keep-alive connection pool, retries failures with exponential backoff and appends
+    anything that still fails (or doesn't fit in the bounded queue) to a size-bounded
+    dead-letter spool file, which is re-queued every replay_interval seconds.
+
+    Every device is routed to one worker with its own queue, so a device's samples reach
+    the endpoint in the order they were queued. Once a newer sample of a device was sent,
+    its older dead letters are superseded and skipped on replay, so a replay never rolls
+    the remote state back.
+
+    In batch mode samples from many devices are coalesced into one JSON array per
+    request (bounded by batch_size and batch_interval, optionally gzip-compressed).
+    The batch endpoint must answer with per-item results; only the rejected items are retried.
+    """
+
+    def __init__(self, host=ENDPOINT_HOST, path=FORWARD_PATH, scheme=FORWARD_SCHEME, workers=FORWARD_WORKERS,
+                 max_queue=FORWARD_QUEUE_SIZE, max_retries=FORWARD_MAX_RETRIES, backoff=FORWARD_BACKOFF,
+                 timeout=FORWARD_TIMEOUT, dead_letter_path=FORWARD_DEAD_LETTER_PATH,
+                 dead_letter_max_bytes=FORWARD_DEAD_LETTER_MAX_BYTES,
+                 replay_interval=FORWARD_DEAD_LETTER_REPLAY_INTERVAL,
+                 batch_mode=FORWARD_BATCH_MODE, batch_path=FORWARD_BATCH_PATH, batch_size=FORWARD_BATCH_SIZE,
+                 batch_interval=FORWARD_BATCH_INTERVAL, batch_gzip=FORWARD_BATCH_GZIP):
+        self.url = f"{scheme}://{host}{path}"
+        self.batch_url = f"{scheme}://{host}{batch_path}"
+        self.batch_mode = batch_mode
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.batch_gzip = batch_gzip
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.dead_letter_path = dead_letter_path
+        self.dead_letter_max_bytes = dead_letter_max_bytes
+        self.replay_interval = replay_interval
+        # One queue per worker; entries are (queued_at, item)
+        self.queues = [queue.Queue(maxsize=max(1, max_queue // workers)) for _ in range(workers)]
+        self.session = requests.Session()
+        self.session.mount(f"{scheme}://", HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self.session.headers.update({'Content-Type': 'application/json'})
+        self.threads = []
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        # Devices with samples in the spool, so their later deliveries are recorded there too
+        self.spooled_devices = set()
+        # Device ID -> queue time of its latest live sample; older dead letters are superseded by it
+        self.latest_queued = {}
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.dead_lettered = 0
+        self.dropped = 0
+        self.replayed = 0
+        self.superseded = 0
+        self.batches = 0
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i, worker_queue in enumerate(self.queues):
+                thread = threading.Thread(target=self._run, args=(worker_queue,), name=f"forwarder-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+            if self.replay_interval:
+                threading.Thread(target=self._replay_loop, name="forwarder-replay", daemon=True).start()
+
+    def pending(self):
+        return sum(worker_queue.qsize() for worker_queue in self.queues)
+
+    def _queue_for(self, device_id):
+        # A stable hash, so a device always lands on the same worker
+        return self.queues[zlib.crc32(str(device_id).encode()) % len(self.queues)]
+
+    def submit(self, device_id, data, queued_at=None):
+        """
+        Queue a sample for forwarding without blocking the caller.
+        queued_at is only passed by the replay, so a replayed sample keeps its original place in time.
+        """
+        self.start()
+        item = {"deviceID": device_id, "data": data}
+        if queued_at is None:
+            queued_at = time.time()
+            with self.lock:
+                self.latest_queued[device_id] = queued_at
+        entry = (queued_at, item)
+        try:
+            self._queue_for(device_id).put_nowait(entry)
+            return True
+        except queue.Full:
+            self._dead_letter(entry, "queue full")
+            return False
+
+    def _run(self, worker_queue):
+        while not (self.stopping.is_set() and worker_queue.empty()):
+            entries = self._collect_batch(worker_queue) if self.batch_mode else self._collect_one(worker_queue)
+            if not entries:
+                continue
+            try:
+                if self.batch_mode:
+                    self._deliver_batch(entries)
+                else:
+                    self._deliver(entries[0])
+            finally:
+                for _ in entries:
+                    worker_queue.task_done()
+
+    def _collect_one(self, worker_queue):
+        try:
+            return [worker_queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+
+    def _collect_batch(self, worker_queue):
+        entries = self._collect_one(worker_queue)
+        if not entries:
+            return entries
+        deadline = time.monotonic() + self.batch_interval
+        while len(entries) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0 or self.stopping.is_set():
+                    # Don't wait any longer, but still take whatever is already queued
+                    entries.append(worker_queue.get_nowait())
+                else:
+                    entries.append(worker_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return entries
+
+    def _deliver(self, entry):
+        item = entry[1]
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.retries += 1
+                forward_results.inc(result="retried")
+                # Exponential backoff with jitter so retries of a burst don't arrive together
+                time.sleep(self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+            error = self._post(item)
+            if error is None:
+                self.sent += 1
+                forward_results.inc(result="sent")
+                print(f"Successfully sent data for device: {item['deviceID']}")
+                self._delivered([entry])
+                return
+        self.failed += 1
+        forward_results.inc(result="failed")
+        print(f"Failed to send data for device: {item['deviceID']}: {error}")
+        self._dead_letter(entry, error)
+
+    def _post(self, item):
+        try:
+            with forward_seconds.time(mode="single"):
+                response = self.session.post(self.url, data=json.dumps(item, default=str), timeout=self.timeout)
+            if response.status_code == 200:
+                return None
+            return f"status code {response.status_code}: {response.text[:200]}"
+        except Exception as e:
+            return str(e)
+
+    def _deliver_batch(self, entries):
+        pending = entries
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.retries += 1
+                forward_results.inc(len(pending), result="retried")
+                time.sleep(self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+            rejected, error = self._post_batch(pending)
+            self.sent += len(pending) - len(rejected)
+            forward_results.inc(len(pending) - len(rejected), result="sent")
+            rejected_ids = {id(entry) for entry in rejected}
+            self._delivered([entry for entry in pending if id(entry) not in rejected_ids])
+            if not rejected:
+                print(f"Successfully sent batch of {len(entries)} samples")
+                return
+            # Only the items the endpoint didn't acknowledge are sent again
+            pending = rejected
+        self.failed += len(pending)
+        forward_results.inc(len(pending), result="failed")
+        print(f"Failed to send {len(pending)} of {len(entries)} batched samples: {error}")
+        for entry in pending:
+            self._dead_letter(entry, error)
+
+    def _post_batch(self, entries):
+        """
+        POST a batch and return (rejected entries, error). The whole batch is rejected on transport errors.
+        """
+        self.batches += 1
+        body = json.dumps([item for _, item in entries], default=str).encode()
+        headers = {}
+        if self.batch_gzip:
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        try:
+            with forward_seconds.time(mode="batch"):
+                response = self.session.post(self.batch_url, data=body, headers=headers, timeout=self.timeout)
+        except Exception as e:
+            return entries, str(e)
+        if response.status_code != 200:
+            return entries, f"status code {response.status_code}: {response.text[:200]}"
+
+        rejected = self._rejected_items(entries, response)
+        if rejected is None:
+            return entries, "response has no per-item results"
+        return rejected, f"{len(rejected)} items rejected by the endpoint" if rejected else None
+
+    def _rejected_items(self, items, response):
+        """
+        Per-item acknowledgment: the endpoint answers with a list (or {"results": [...]})
+        aligned with the request. Returns None if it didn't, as a bare 200 doesn't say
+        which items were stored (e.g. a single-sample endpoint that got an array).
+        """
+        try:
+            body = response.json()
+        except ValueError:
+            return None
+        results = body.get('results') if isinstance(body, dict) else body
+        if not isinstance(results, list) or len(results) != len(items):
+            return None
+        return [item for item, result in zip(items, results) if not is_acknowledged(result)]
+
+    def _delivered(self, entries):
+        """
+        Record in the spool that these samples were sent, for devices that have dead letters:
+        their older dead letters are superseded and won't be replayed.
+        """
+        with self.lock:
+            markers = [
+                {"delivered": item["deviceID"], "queued_at": queued_at}
+                for queued_at, item in entries if item["deviceID"] in self.spooled_devices
+            ]
+        try:
+            for marker in markers:
+                self._append_to_spool(marker)
+        except Exception as e:
+            print(f"Error recording deliveries in the dead-letter spool: {e}")
+
+    def _append_to_spool(self, record):
+        with self.lock:
+            os.makedirs(os.path.dirname(self.dead_letter_path) or ".", mode=0o700, exist_ok=True)
+            with open(self.dead_letter_path, "a") as spool:
+                spool.write(json.dumps(record, default=str) + "\n")
+
+    def _dead_letter(self, entry, reason):
+        queued_at, item = entry
+        record = {"failed_at": datetime.now().isoformat(), "queued_at": queued_at, "reason": reason, "item": item}
+        try:
+            with self.lock:
+                if os.path.exists(self.dead_letter_path) and \
+                        os.path.getsize(self.dead_letter_path) >= self.dead_letter_max_bytes:
+                    self.dropped += 1
+                    forward_results.inc(result="dropped")
+                    print(f"Dead-letter spool is full, dropping sample of device {item.get('deviceID')}")
+                    return
+                self.spooled_devices.add(item["deviceID"])
+            self._append_to_spool(record)
+            self.dead_lettered += 1
+            forward_results.inc(result="dead_lettered")
+        except Exception as e:
+            print(f"Error writing dead letter for device {item.get('deviceID')}: {e}")
+
+    def _replay_loop(self):
+        # Replays once at startup, then every replay_interval seconds until close()
+        while not self.stopping.is_set():
+            # Don't refill queues that are still busy, replayed samples would only overflow them again
+            if self.pending() < self.max_queue // 2:
+                try:
+                    count = self.replay_dead_letters()
+                    if count:
+                        print(f"Re-queued {count} dead-lettered samples")
+                except Exception as e:
+                    print(f"Error replaying dead letters: {e}")
+            self.stopping.wait(self.replay_interval)
+
+    def replay_dead_letters(self):
+        """
+        Re-queue the dead letters that no newer sample of their device, sent or queued, superseded.
+        Unreadable lines are skipped. Returns the number of samples re-queued.
+        """
+        replay_path = f"{self.dead_letter_path}.replay"
+        with self.lock:
+            if os.path.exists(self.dead_letter_path):
+                if os.path.exists(replay_path):
+                    # Left over from an interrupted replay: add to it instead of replacing it
+                    with open(self.dead_letter_path) as spool, open(replay_path, "a") as replay:
+                        replay.write(spool.read())
+                    os.remove(self.dead_letter_path)
+                else:
+                    os.replace(self.dead_letter_path, replay_path)
+            elif not os.path.exists(replay_path):
+                return 0
+            # Deliveries from here on are recorded in the new spool
+            self.spooled_devices.clear()
+
+        records = []
+        delivered = {}
+        with open(replay_path) as replay:
+            for line in replay:
+                try:
+                    record = json.loads(line)
+                    if "delivered" in record:
+                        device_id = record["delivered"]
+                        delivered[device_id] = max(delivered.get(device_id, 0), record["queued_at"])
+                    else:
+                        records.append((record.get("queued_at") or 0, record["item"]))
+                except (ValueError, KeyError, TypeError) as e:
+                    # e.g. a line truncated by a crash mid-write
+                    print(f"Skipping unreadable dead letter: {e}")
+
+        with self.lock:
+            latest_queued = dict(self.latest_queued)
+        count = 0
+        for queued_at, item in sorted(records, key=lambda record: record[0]):
+            device_id = item["deviceID"]
+            # This or a newer sample of the device was sent, or a newer one is queued:
+            # replaying this one would roll the remote state back
+            if queued_at <= delivered.get(device_id, -1) or queued_at < latest_queued.get(device_id, -1):
+                self.superseded += 1
+                continue
+            if self.submit(device_id, item["data"], queued_at=queued_at):
+                count += 1
+        os.remove(replay_path)
+        self.replayed += count
+        return count
+
+    def close(self, timeout=FORWARD_SHUTDOWN_TIMEOUT):
+        """
+        Stop accepting work and give the workers up to timeout seconds to drain their queues.
+        Whatever is still queued afterwards goes to the dead-letter spool.
+        """
+        self.stopping.set()
+        deadline = time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        for worker_queue in self.queues:
+            while True:
+                try:
+                    self._dead_letter(worker_queue.get_nowait(), "shutdown")
+                except queue.Empty:
+                    break
+        self.session.close()
+
+    def stats(self):
+        return {
+            "queued": self.pending(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "dead_lettered": self.dead_lettered,
+            "dropped": self.dropped,
+            "replayed": self.replayed,
+            "superseded": self.superseded,
+            "batches": self.batches
+        }
+
+
+# Shared by every poller in the process
+forwarder = EndpointForwarder()
+queue_depth.set_function(forwarder.pending, queue="forward")
@@ -0,0 +1,158 @@
+import threading
+import time
+
+import tinytuya
+
+import sys
+import os
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config.settings import LOCAL_CONTROL_ENABLED, LOCAL_DEVICES, LOCAL_SOCKET_TIMEOUT, LOCAL_RETRY_AFTER
+
+
+class LocalDevice:
+    """
+    A device reached over the LAN with tinytuya's local protocol on a persistent socket.
+    DP ids are translated to/from the DP codes the cloud API uses, so callers see the same shapes;
+    DPs without a code in the mapping are not reported, as the cloud would not report them either.
+    """
+
+    def __init__(self, device_id, local_key, address="Auto", version=3.3, mapping=None):
+        self.device_id = device_id
+        self.mapping = mapping or {}
+        self.dp_ids = {item['code']: dp_id for dp_id, item in self.mapping.items() if 'code' in item}
+        self.codes = {dp_id: code for code, dp_id in self.dp_ids.items()}
+        self.lock = threading.Lock()
+        self.device = tinytuya.Device(device_id, address=address, local_key=local_key, version=version)
+        self.device.set_socketPersistent(True)
+        self.device.set_socketTimeout(LOCAL_SOCKET_TIMEOUT)
+
+    def get_status(self):
+        with self.lock:
+            data = self.device.status()
+        if not data or 'Error' in data or 'dps' not in data:
+            raise ConnectionError(f"Local status failed: {data}")
+        return {
+            'result': [
+                {'code': self.codes[dp_id], 'value': value}
+                for dp_id, value in data['dps'].items() if dp_id in self.codes
+            ],
+            'success': True,
+            't': int(time.time() * 1000)
+        }
+
+    def send_command(self, commands):
+        dps = {}
+        for command in commands.get('commands', []):
+            if command['code'] not in self.dp_ids:
+                raise KeyError(f"No local DP for code {command['code']}")
+            dps[self.dp_ids[command['code']]] = command['value']
+        with self.lock:
+            data = self.device.set_multiple_values(dps)
+        if data and 'Error' in data:
+            raise ConnectionError(f"Local command failed: {data}")
+        return {'result': True, 'success': True, 't': int(time.time() * 1000)}
+
+    def close(self):
+        with self.lock:
+            self.device.close()
+
+
+class LocalRoute:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.device = None
+        self.retry_at = 0
+        self.local_ok = 0
+        self.local_failures = 0
+        self.cloud_fallbacks = 0
+        self.local_time = 0.0
+
+    def stats(self):
+        return {
+            "connected": self.device is not None,
+            "local_ok": self.local_ok,
+            "local_failures": self.local_failures,
+            "cloud_fallbacks": self.cloud_fallbacks,
+            "avg_local_ms": round(self.local_time / self.local_ok * 1000, 1) if self.local_ok else None
+        }
+
+
+class LocalRouter:
+    """
+    Routes status reads and commands of the devices listed in LOCAL_DEVICES over the LAN,
+    falling back to the cloud on any failure. The local key and DP mapping are discovered
+    once per device through the cloud device list; a device whose local path failed is
+    only retried after LOCAL_RETRY_AFTER seconds.
+    """
+
+    def __init__(self, enabled=LOCAL_CONTROL_ENABLED, devices=LOCAL_DEVICES):
+        self.enabled = enabled
+        self.devices = devices
+        self.routes = {}
+        self.lock = threading.Lock()
+
+    def handles(self, device_id):
+        return self.enabled and device_id in self.devices
+
+    def _route(self, device_id):
+        with self.lock:
+            route = self.routes.get(device_id)
+            if route is None:
+                route = self.routes[device_id] = LocalRoute()
+            return route
+
+    def _connect(self, manager, route):
+        config = self.devices[manager.device_id]
+        for device in manager.cloud_call('getdevices', verbose=False, include_map=True, coalesce=True):
+            if device['id'] == manager.device_id:
+                if not device.get('mapping'):
+                    raise LookupError(f"No DP mapping for device {manager.device_id}, keeping it on the cloud")
+                route.device = LocalDevice(
+                    manager.device_id,
+                    device['key'],
+                    address=config.get('address', 'Auto'),
+                    version=config.get('version', 3.3),
+                    mapping=device.get('mapping')
+                )
+                return
+        raise LookupError(f"Device {manager.device_id} not found in the cloud device list")
+
+    def call(self, manager, method, cloud_call, *args):
+        """
+        Run method on the local device if it is routed locally, otherwise (or if that fails) run cloud_call.
+        """
+        if not self.handles(manager.device_id):
+            return cloud_call(*args)
+
+        route = self._route(manager.device_id)
+        if time.monotonic() >= route.retry_at:
+            started = time.monotonic()
+            try:
+                with route.lock:
+                    if route.device is None:
+                        self._connect(manager, route)
+                result = getattr(route.device, method)(*args)
+                route.local_ok += 1
+                route.local_time += time.monotonic() - started
+                return result
+            except Exception as e:
+                print(f"Local {method} failed for device {manager.device_id}, using cloud: {e}")
+                route.local_failures += 1
+                route.retry_at = time.monotonic() + LOCAL_RETRY_AFTER
+                with route.lock:
+                    if route.device is not None:
+                        route.device.close()
+                        route.device = None
+
+        route.cloud_fallbacks += 1
+        return cloud_call(*args)
+
+    def stats(self):
+        with self.lock:
+            return {device_id: route.stats() for device_id, route in self.routes.items()}
+
+
+# Shared by every TuyaDeviceManager in the process
+local_router = LocalRouter()
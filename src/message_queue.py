@@ -0,0 +1,208 @@
+import base64
+import hashlib
+import json
+import queue
+import threading
+
+import tinytuya
+
+import sys
+import os
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config.settings import MQ_ENDPOINTS, MQ_ENV, MQ_ACK_TIMEOUT_MS, MQ_RECONNECT_DELAY
+
+# websocket-client is only needed for the real Tuya message service
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+
+def decrypt_data(data, access_key, t=None, encrypt_model=None):
+    """
+    Decrypt the 'data' field of a Tuya message service payload.
+    The key is characters 8-24 of the project's access secret; messages are AES-ECB
+    unless the payload says encryptModel 'aes_gcm' (12 byte nonce + ciphertext + 16 byte tag, t as AAD).
+    """
+    cipher = tinytuya.AESCipher(access_key[8:24].encode())
+    if encrypt_model == 'aes_gcm':
+        raw = base64.b64decode(data)
+        return cipher.decrypt(raw[12:-16], use_base64=False, decode_text=True, iv=raw[:12],
+                              header=str(t).encode(), tag=raw[-16:])
+    return cipher.decrypt(data, use_base64=True, decode_text=True)
+
+
+def decode_message(payload, access_key):
+    """
+    Decode a message service payload into the device report it carries.
+
+    Args:
+    payload: Message payload, JSON bytes/str with an encrypted 'data' field.
+    access_key: Project access secret.
+
+    Returns:
+    dict: The decrypted report, e.g. {'devId': ..., 'status': [{'code', 'value', 't'}, ...]}.
+    """
+    if isinstance(payload, bytes):
+        payload = payload.decode()
+    message = json.loads(payload)
+    data = decrypt_data(message['data'], access_key, message.get('t'), message.get('encryptModel'))
+    report = json.loads(data)
+    report.setdefault('t', message.get('t'))
+    return report
+
+
+def report_to_status(report):
+    """
+    Turn a device status report into the shape returned by TuyaDeviceManager.get_status().
+    Only the reported DPs are included, so the result has to be merged onto the last known state.
+    """
+    return {
+        'result': [{'code': item['code'], 'value': item['value']} for item in report.get('status', [])],
+        'success': True,
+        't': report.get('t')
+    }
+
+
+class LocalQueueTransport:
+    """
+    In-process stand-in for the message broker, for development and tests.
+    publish() plays the role of Tuya; unacknowledged messages are kept for inspection.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.unacked = {}
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        pass
+
+    def publish(self, payload):
+        with self.lock:
+            self.counter += 1
+            message_id = str(self.counter)
+        self.queue.put((message_id, payload))
+        return message_id
+
+    def receive(self, timeout=1):
+        try:
+            message_id, payload = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        with self.lock:
+            self.unacked[message_id] = payload
+        return message_id, payload
+
+    def acknowledge(self, message_id):
+        with self.lock:
+            self.unacked.pop(message_id, None)
+
+    def close(self):
+        pass
+
+
+class TuyaWebSocketTransport:
+    """
+    Tuya's message service: a Pulsar topic per project, consumed through Pulsar's WebSocket API.
+    """
+
+    def __init__(self, api_region, access_id, access_key, env=MQ_ENV):
+        if websocket is None:
+            raise RuntimeError("websocket-client is required for the Tuya message service")
+        self.url = (
+            f"{MQ_ENDPOINTS[api_region]}ws/v2/consumer/persistent/{access_id}/out/{env}/{access_id}-sub"
+            f"?ackTimeoutMillis={MQ_ACK_TIMEOUT_MS}&subscriptionType=Failover"
+        )
+        password = hashlib.md5((access_id + hashlib.md5(access_key.encode()).hexdigest()).encode()).hexdigest()[8:24]
+        self.headers = ["Connection: Upgrade", f"username: {access_id}", f"password: {password}"]
+        self.socket = None
+
+    def connect(self):
+        self.socket = websocket.create_connection(self.url, header=self.headers)
+
+    def receive(self, timeout=1):
+        self.socket.settimeout(timeout)
+        try:
+            frame = json.loads(self.socket.recv())
+        except websocket.WebSocketTimeoutException:
+            return None
+        return frame['messageId'], base64.b64decode(frame['payload'])
+
+    def acknowledge(self, message_id):
+        self.socket.send(json.dumps({"messageId": message_id}))
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+
+class TuyaMessageConsumer:
+    """
+    Push ingestion: reads device reports from a transport on a background thread and hands
+    each status report to handle_status(device_id, status). A message is only acknowledged
+    once it was handled, so failures are redelivered by the broker.
+    """
+
+    def __init__(self, transport, access_key, handle_status, reconnect_delay=MQ_RECONNECT_DELAY):
+        self.transport = transport
+        self.access_key = access_key
+        self.handle_status = handle_status
+        self.reconnect_delay = reconnect_delay
+        self.stopping = threading.Event()
+        self.thread = None
+        self.received = 0
+        self.handled = 0
+        self.errors = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="tuya-mq", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.transport.close()
+
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                self.transport.connect()
+                while not self.stopping.is_set():
+                    message = self.transport.receive(timeout=1)
+                    if message is not None:
+                        self.process(*message)
+            except Exception as e:
+                self.errors += 1
+                print(f"Error consuming Tuya messages, reconnecting: {e}")
+                self.transport.close()
+                self.stopping.wait(self.reconnect_delay)
+
+    def process(self, message_id, payload):
+        self.received += 1
+        try:
+            report = decode_message(payload, self.access_key)
+        except Exception as e:
+            # Undecodable messages would be redelivered forever, drop them
+            self.errors += 1
+            print(f"Error decoding Tuya message {message_id}: {e}")
+            self.transport.acknowledge(message_id)
+            return
+
+        try:
+            # Only status reports feed the pipeline; online/offline and other bizCode events are skipped
+            if report.get('devId') and report.get('status'):
+                self.handle_status(report['devId'], report_to_status(report))
+                self.handled += 1
+            self.transport.acknowledge(message_id)
+        except Exception as e:
+            self.errors += 1
+            print(f"Error handling Tuya message {message_id} for device {report.get('devId')}: {e}")
+
+    def stats(self):
+        return {"received": self.received, "handled": self.handled, "errors": self.errors}
@@ -0,0 +1,212 @@
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, (), value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for name, key, extra, value in self.samples():
+            lines.append(f"{name}{format_labels(self.label_names, key, extra)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. Besides set(), a gauge can read its value from a
+    callback at scrape time, which is how queue depths are exported without touching the hot path.
+    """
+    type = "gauge"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self.functions = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def remove(self, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values.pop(key, None)
+            self.functions.pop(key, None)
+
+    def set_function(self, function, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.functions[key] = function
+
+    def samples(self):
+        samples = super().samples()
+        with self.lock:
+            functions = list(self.functions.items())
+        for key, function in functions:
+            try:
+                samples.append((self.name, key, (), function()))
+            except Exception as e:
+                print(f"Error reading gauge {self.name}: {e}")
+        return samples
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts["buckets"][i] += 1
+                    break
+            counts["sum"] += value
+            counts["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, counts in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts["buckets"]):
+                    cumulative += count
+                    samples.append((f"{self.name}_bucket", key, (("le", format_value(bound)),), cumulative))
+                samples.append((f"{self.name}_sum", key, (), counts["sum"]))
+                samples.append((f"{self.name}_count", key, (), counts["count"]))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+def start_http_server(port, registry=None, host="0.0.0.0"):
+    """
+    Serve the registry in the Prometheus text format on http://host:port/metrics from a daemon thread.
+    """
+    registry = registry or metrics_registry
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes every few seconds would flood the log
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+# Shared by every module in the process
+metrics_registry = MetricsRegistry()
+
+tuya_call_seconds = metrics_registry.register(Histogram(
+    "tuya_call_seconds", "Latency of Tuya cloud API calls", ["client", "endpoint"]))
+tuya_rate_limit_wait_seconds = metrics_registry.register(Histogram(
+    "tuya_rate_limit_wait_seconds", "Time Tuya calls waited for the per-credential rate limit", ["client"]))
+mongo_read_seconds = metrics_registry.register(Histogram(
+    "mongo_read_seconds", "Latency of MongoDB reads", ["operation"]))
+mongo_write_seconds = metrics_registry.register(Histogram(
+    "mongo_write_seconds", "Latency of MongoDB writes", ["operation"]))
+forward_seconds = metrics_registry.register(Histogram(
+    "forward_seconds", "Latency of posts to the remote tuyapayload endpoint", ["mode"]))
+forward_results = metrics_registry.register(Counter(
+    "forward_results_total", "Samples forwarded to the remote endpoint by outcome", ["result"]))
+poll_lag_seconds = metrics_registry.register(Histogram(
+    "poll_lag_seconds", "Delay between a device's due time and the start of its poll",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)))
+device_poll_lag_seconds = metrics_registry.register(Gauge(
+    "device_poll_lag_seconds", "Delay of the latest poll of each device behind its due time", ["device_id"]))
+device_poll_interval_seconds = metrics_registry.register(Gauge(
+    "device_poll_interval_seconds", "Current adaptive poll interval of each device", ["device_id"]))
+change_detection_total = metrics_registry.register(Counter(
+    "change_detection_total", "Device statuses checked for changes by outcome", ["result"]))
+queue_depth = metrics_registry.register(Gauge(
+    "queue_depth", "Items waiting in the process's internal queues", ["queue"]))
+http_request_seconds = metrics_registry.register(Histogram(
+    "http_request_seconds", "Latency of API requests", ["method", "route", "status"]))
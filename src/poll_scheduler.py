@@ -0,0 +1,254 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import sys
+import os
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config.settings import *
+from src.tuya_cloud_connect import chunked
+from src.metrics import poll_lag_seconds, device_poll_lag_seconds, device_poll_interval_seconds, queue_depth
+
+
+class PolledDevice:
+    def __init__(self, manager, interval, category=None, max_interval=None):
+        self.manager = manager
+        self.device_id = manager.device_id
+        self.min_interval = interval
+        self.max_interval = max(interval, max_interval or interval)
+        self.interval = interval
+        self.category = category
+        self.next_due = None
+        self.due_at = None
+        self.polls = 0
+        self.changes = 0
+
+    def observe(self, changed, backoff):
+        """
+        Adapt the interval to the observed change rate: back to the minimum after a change,
+        exponentially longer (up to the maximum) while the device stays quiet.
+        """
+        self.polls += 1
+        if changed:
+            self.changes += 1
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * backoff, self.max_interval)
+
+
+class PollScheduler:
+    """
+    Single-process poller for any number of devices.
+
+    Devices sit in a priority queue ordered by their next due time. Each tick pops
+    everything that is due (plus anything due within POLL_BATCH_WINDOW, so neighbours
+    share a request), groups it by credential set, reads each chunk with one batch
+    status call in a bounded worker pool and hands every status to process_status.
+
+    With adaptive polling, process_status returns whether the device changed and each
+    device's interval moves between its category's min and max bounds accordingly.
+    """
+
+    def __init__(self, process_status, max_concurrency=POLL_MAX_CONCURRENCY, jitter=POLL_JITTER,
+                 batch_window=POLL_BATCH_WINDOW, batch_size=TUYA_STATUS_BATCH_SIZE,
+                 adaptive=ADAPTIVE_POLLING, backoff=POLL_BACKOFF_FACTOR):
+        self.process_status = process_status
+        self.adaptive = adaptive
+        self.backoff = backoff
+        self.max_concurrency = max_concurrency
+        self.jitter = jitter
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.devices = {}
+        self._queue = []
+        self._counter = itertools.count()
+        self._tasks = set()
+        # Polls get their own workers, so they don't hold up the asyncio.to_thread calls
+        # of the rest of the updater (heartbeats, registry refresh, rules)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="poll")
+        self._loop = None
+        self._stop = None
+        self._wakeup = None
+        queue_depth.set_function(lambda: len(self.devices), queue="polled_devices")
+        queue_depth.set_function(lambda: len(self._tasks), queue="polls_in_flight")
+
+    def interval_for(self, device_id, category=None):
+        if device_id in POLL_INTERVALS_BY_DEVICE:
+            return POLL_INTERVALS_BY_DEVICE[device_id]
+        if category in POLL_INTERVALS_BY_CATEGORY:
+            return POLL_INTERVALS_BY_CATEGORY[category]
+        return POLL_INTERVAL
+
+    def max_interval_for(self, category=None):
+        if not self.adaptive:
+            return None
+        return POLL_MAX_INTERVALS_BY_CATEGORY.get(category, POLL_MAX_INTERVAL)
+
+    def add_device(self, manager, interval=None, category=None):
+        if interval is None:
+            interval = self.interval_for(manager.device_id, category)
+        device = PolledDevice(manager, interval, category, self.max_interval_for(category))
+        self.devices[device.device_id] = device
+        # Spread the first poll over one interval so a cold start doesn't fire everything at once
+        self._schedule(device, time.monotonic() + random.uniform(0, interval))
+        return device
+
+    def remove_device(self, device_id):
+        # The stale queue entry is skipped when it is popped
+        device_poll_lag_seconds.remove(device_id=device_id)
+        device_poll_interval_seconds.remove(device_id=device_id)
+        return self.devices.pop(device_id, None)
+
+    def notify_command(self, device_id, delay=POLL_AFTER_COMMAND_DELAY):
+        """
+        A command was sent to the device: tighten its interval and poll it again shortly.
+        Must be called from the scheduler's event loop.
+        """
+        device = self.devices.get(device_id)
+        if device is None:
+            return
+        device.interval = device.min_interval
+        due = time.monotonic() + delay
+        # In-flight devices are rescheduled with the tightened interval when their poll finishes
+        if device.next_due is not None and device.next_due > due:
+            self._schedule(device, due)
+
+    def use_push(self, device_id, interval=MQ_RECONCILE_INTERVAL):
+        """
+        The device pushes its own reports, keep polling it only as a slow safety net.
+        Must be called from the scheduler's event loop.
+        """
+        device = self.devices.get(device_id)
+        if device is None or device.min_interval == interval:
+            return
+        device.min_interval = device.max_interval = device.interval = interval
+
+    def call_soon(self, callback, *args):
+        """
+        Run callback on the scheduler's event loop, from any thread.
+        """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    def _schedule(self, device, due):
+        device.next_due = due
+        heapq.heappush(self._queue, (due, next(self._counter), device.device_id))
+        self._wake()
+
+    def _reschedule(self, device):
+        if self.devices.get(device.device_id) is not device:
+            return
+        spread = device.interval * self.jitter
+        self._schedule(device, time.monotonic() + device.interval + random.uniform(-spread, spread))
+
+    def _wake(self):
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _pop_due(self, now):
+        due = []
+        # Devices due within the batch window only ride along when something is actually due
+        if not self._queue or self._queue[0][0] > now:
+            return due
+        while self._queue and self._queue[0][0] <= now + self.batch_window:
+            due_time, _, device_id = heapq.heappop(self._queue)
+            device = self.devices.get(device_id)
+            if device is None or device.next_due != due_time:
+                continue
+            device.next_due = None
+            device.due_at = due_time
+            due.append(device)
+        return due
+
+    def _next_delay(self, now):
+        if not self._queue:
+            return None
+        return max(0.0, self._queue[0][0] - now)
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        print(f"Poll scheduler started with {len(self.devices)} devices")
+        while not self._stop.is_set():
+            now = time.monotonic()
+            due = self._pop_due(now)
+
+            # Group due devices by credential set so each chunk is one batch status call
+            groups = {}
+            for device in due:
+                groups.setdefault(device.manager.credentials, []).append(device)
+            for devices in groups.values():
+                for chunk in chunked(devices, self.batch_size):
+                    task = asyncio.create_task(self._poll_batch(chunk, semaphore))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+
+            self._wakeup.clear()
+            delay = self._next_delay(time.monotonic())
+            wait_for = [asyncio.ensure_future(self._stop.wait()), asyncio.ensure_future(self._wakeup.wait())]
+            await asyncio.wait(wait_for, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in wait_for:
+                waiter.cancel()
+
+        # Graceful shutdown: let in-flight polls finish writing before returning
+        if self._tasks:
+            print(f"Waiting for {len(self._tasks)} in-flight polls to finish")
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self.executor.shutdown(wait=False)
+        print("Poll scheduler stopped")
+
+    def stop(self):
+        if self._loop is not None and self._stop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+    async def _poll_batch(self, devices, semaphore):
+        async with semaphore:
+            # Lag: how long after its due time a device's poll actually starts (queueing for a worker included)
+            now = time.monotonic()
+            for device in devices:
+                lag = max(0.0, now - device.due_at)
+                poll_lag_seconds.observe(lag)
+                device_poll_lag_seconds.set(lag, device_id=device.device_id)
+            try:
+                manager = devices[0].manager
+                device_ids = [device.device_id for device in devices]
+                statuses = await self._loop.run_in_executor(self.executor, manager.get_status_batch, device_ids)
+                await self._loop.run_in_executor(self.executor, self._process_batch, devices, statuses)
+            except Exception as e:
+                print(f"Error polling devices: {e}")
+            finally:
+                for device in devices:
+                    self._reschedule(device)
+
+    def _process_batch(self, devices, statuses):
+        for device in devices:
+            device_status = statuses.get(device.device_id)
+            if not device_status or not device_status.get('success'):
+                print(f"Failed to get status for device: {device.device_id}: {device_status}")
+                continue
+            try:
+                changed = self.process_status(device.device_id, device_status)
+                if self.adaptive:
+                    device.observe(bool(changed), self.backoff)
+                    device_poll_interval_seconds.set(device.interval, device_id=device.device_id)
+            except Exception as e:
+                print(f"Error processing status for device {device.device_id}: {e}")
+
+    def stats(self):
+        intervals = [device.interval for device in self.devices.values()]
+        return {
+            "devices": len(self.devices),
+            "queued": len(self._queue),
+            "in_flight": len(self._tasks),
+            "avg_interval": sum(intervals) / len(intervals) if intervals else None,
+            "polls": sum(device.polls for device in self.devices.values()),
+            "changes": sum(device.changes for device in self.devices.values())
+        }
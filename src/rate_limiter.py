@@ -0,0 +1,149 @@
+import threading
+import time
+
+import sys
+import os
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config.settings import (TUYA_RATE_LIMIT_QPS, TUYA_RATE_LIMIT_BURST, TUYA_RATE_LIMIT_PROCESSES,
+                             TUYA_RATE_LIMIT_MAX_WAIT)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: rate tokens per second, up to capacity banked for bursts.
+
+    The bucket only limits the process it lives in. The API server and the updater each
+    get 1/TUYA_RATE_LIMIT_PROCESSES of the configured limits, so together they stay within them.
+    """
+
+    def __init__(self, rate=TUYA_RATE_LIMIT_QPS / TUYA_RATE_LIMIT_PROCESSES,
+                 capacity=max(1, TUYA_RATE_LIMIT_BURST // TUYA_RATE_LIMIT_PROCESSES),
+                 max_wait=TUYA_RATE_LIMIT_MAX_WAIT):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_wait = max_wait
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.waited = 0.0
+        self.rejected = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """
+        Take a token, possibly going into debt, and return how long the caller must wait before using it.
+        Reserving (instead of polling) keeps waiters in FIFO order and lets async callers sleep without blocking.
+
+        Returns None, without taking a token, if the wait would exceed max_wait, so the debt stays bounded.
+        """
+        with self.lock:
+            self._refill()
+            delay = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+            if delay > self.max_wait:
+                self.rejected += 1
+                return None
+            self.tokens -= 1
+            self.waited += delay
+            return delay
+
+    def refund(self):
+        """
+        Give back a reserved token that won't be used, e.g. because its caller was cancelled while waiting.
+        """
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def acquire(self):
+        """
+        Wait for a token. Returns False if the wait would exceed max_wait.
+        """
+        delay = self.reserve()
+        if delay is None:
+            return False
+        if delay > 0:
+            time.sleep(delay)
+        return True
+
+
+def rate_limited_response():
+    """
+    Failure response, shaped like Tuya's, of a call that was refused a token.
+    """
+    return {'success': False, 'msg': f'Rate limited: no token within {TUYA_RATE_LIMIT_MAX_WAIT} seconds'}
+
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight calls: while a call for a key is running, other callers
+    with the same key wait for it and share its result (or exception) instead of calling again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn, *args):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self.calls[key] = {"done": threading.Event(), "result": None, "error": None}
+                leader = True
+
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn(*args)
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call["done"].set()
+
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(api_region, api_key):
+    """
+    The token bucket shared by every call made with one (region, API key) in this process.
+    """
+    with rate_limiters_lock:
+        limiter = rate_limiters.get((api_region, api_key))
+        if limiter is None:
+            limiter = rate_limiters[(api_region, api_key)] = TokenBucket()
+        return limiter
+
+
+def rate_limiter_stats():
+    with rate_limiters_lock:
+        return {
+            f"{api_region}:{api_key}": {
+                "tokens": round(limiter.tokens, 2),
+                "waited": round(limiter.waited, 2),
+                "rejected": limiter.rejected
+            }
+            for (api_region, api_key), limiter in rate_limiters.items()
+        }
+
+
+# Shared by every TuyaDeviceManager in the process
+single_flight = SingleFlight()
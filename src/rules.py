@@ -0,0 +1,234 @@
+import operator
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time as dt_time
+
+import sys
+import os
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config.settings import RULES_COMMAND_WORKERS
+
+OPERATORS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne
+}
+
+
+class Condition:
+    """
+    One DP comparison, e.g. {"device": id, "code": "temp_current", "op": ">", "value": 25}.
+    Values are compared raw, as the device reports them (no DP scaling).
+
+    With a hysteresis, a condition that holds keeps holding until the value is
+    hysteresis past the threshold the other way, so a reading hovering around the
+    threshold doesn't toggle the rule.
+    """
+
+    def __init__(self, device, code, op, value, hysteresis=0):
+        if op not in OPERATORS:
+            raise ValueError(f"Unknown operator {op!r}")
+        self.device_id = device
+        self.code = code
+        self.op = op
+        self.value = value
+        self.hysteresis = hysteresis
+        self.state = False
+
+    def evaluate(self, values):
+        current = values.get(self.code)
+        try:
+            if current is None:
+                self.state = False
+            elif self.state and self.hysteresis and self.op in (">", ">="):
+                self.state = current > self.value - self.hysteresis
+            elif self.state and self.hysteresis and self.op in ("<", "<="):
+                self.state = current < self.value + self.hysteresis
+            else:
+                self.state = OPERATORS[self.op](current, self.value)
+        except TypeError:
+            # e.g. a DP that reports a string where a number was expected
+            self.state = False
+        return self.state
+
+
+def parse_time_window(between):
+    if not between:
+        return None
+    start, end = (dt_time.fromisoformat(value) for value in between)
+    return start, end
+
+
+def in_time_window(window, now):
+    if window is None:
+        return True
+    start, end = window
+    current = now.time()
+    # A window like ["22:00", "06:00"] wraps around midnight
+    if start <= end:
+        return start <= current < end
+    return current >= start or current < end
+
+
+class Rule:
+    """
+    A compiled rule:
+
+        {
+            "name": "...",
+            "when": [condition, ...],      # all must hold for the rule to be on
+            "only_if": [condition, ...],   # optional guards, transitions wait while they don't hold
+            "between": ["06:00", "20:00"], # optional local time window, a guard as well
+            "then": {"device": id, "commands": [...]},       # sent when the rule turns on
+            "otherwise": {"device": id, "commands": [...]}   # optional, sent when it turns off
+        }
+
+    Rules are edge triggered: a command is only sent when the rule's state flips.
+    """
+
+    def __init__(self, name, when, then, otherwise=None, only_if=(), between=None):
+        self.name = name
+        self.conditions = [Condition(**condition) for condition in when]
+        self.guards = [Condition(**condition) for condition in only_if]
+        self.window = parse_time_window(between)
+        self.then = then
+        self.otherwise = otherwise
+        self.target = then["device"]
+        # Unknown until the first evaluation, which brings the target in line either way
+        self.active = None
+        self.fired = 0
+
+    def dependencies(self):
+        return {(condition.device_id, condition.code) for condition in self.conditions + self.guards}
+
+    def evaluate(self, get_values, now):
+        """
+        Re-evaluate the rule and return the action to send if its state flipped, else None.
+        """
+        # Every condition is evaluated (no short-circuit) so hysteresis states stay current
+        state = all([condition.evaluate(get_values(condition.device_id)) for condition in self.conditions])
+        guarded = all([guard.evaluate(get_values(guard.device_id)) for guard in self.guards])
+        if state == self.active or not guarded or not in_time_window(self.window, now):
+            return None
+        self.active = state
+        return self.then if state else self.otherwise
+
+
+class RuleEngine:
+    """
+    Evaluates rules reactively. Rules are compiled once and indexed by the (device, DP code)
+    pairs they depend on; on_change() only evaluates the rules of the DPs that actually
+    changed, so idle rules cost nothing. Commands are sent on a small thread pool and
+    skipped when the target already reports the commanded values. send_command returns
+    whether the command was accepted; a rule whose command failed is evaluated afresh.
+
+    With owns(device_id), e.g. in sharding mode, a rule is only evaluated on the node that
+    owns its target. Changes of devices polled by other nodes never reach on_change() here,
+    so rules depending on them are re-checked by tick() instead.
+    """
+
+    def __init__(self, rules, send_command, get_values, owns=None, workers=RULES_COMMAND_WORKERS):
+        self.send_command = send_command
+        self.get_values = get_values
+        self.owns = owns
+        self.rules = [Rule(**rule) for rule in rules]
+        self.index = {}
+        for rule in self.rules:
+            for dependency in rule.dependencies():
+                self.index.setdefault(dependency, []).append(rule)
+        self.timed = [rule for rule in self.rules if rule.window is not None]
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rules")
+        self.evaluations = 0
+        self.commands = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def on_change(self, device_id, changes):
+        """
+        Evaluate the rules that depend on the changed DPs of a device.
+
+        Args:
+        device_id: ID of the device.
+        changes: DP code -> new value of the DPs that changed.
+        """
+        rules = dict.fromkeys(
+            rule for code in changes for rule in self.index.get((device_id, code), ()) if self._owns(rule.target)
+        )
+        if rules:
+            self._evaluate(rules)
+
+    def tick(self):
+        """
+        Re-check the rules of this node whose state can change without a local DP changing:
+        rules with a time window and rules depending on devices owned by another node.
+        """
+        self._evaluate([
+            rule for rule in self.rules
+            if self._owns(rule.target)
+            and (rule.window is not None or not all(self._owns(device_id) for device_id, _ in rule.dependencies()))
+        ])
+
+    def has_timer(self):
+        return bool(self.timed) or self.owns is not None
+
+    def _owns(self, device_id):
+        return self.owns is None or self.owns(device_id)
+
+    def _evaluate(self, rules):
+        # One value lookup per device per evaluation round
+        values = {}
+
+        def get_values(device_id):
+            if device_id not in values:
+                values[device_id] = self.get_values(device_id) or {}
+            return values[device_id]
+
+        now = datetime.now()
+        actions = []
+        with self.lock:
+            for rule in rules:
+                self.evaluations += 1
+                action = rule.evaluate(get_values, now)
+                if action is not None:
+                    rule.fired += 1
+                    actions.append((rule, action))
+
+        for rule, action in actions:
+            current = get_values(action["device"])
+            if all(current.get(command["code"]) == command["value"] for command in action["commands"]):
+                self.skipped += 1
+                continue
+            print(f"Rule '{rule.name}' turned {'on' if rule.active else 'off'}, commanding device {action['device']}")
+            self.commands += 1
+            self.executor.submit(self._send, rule, action)
+
+    def _send(self, rule, action):
+        try:
+            if self.send_command(action["device"], {"commands": action["commands"]}):
+                return
+            print(f"Command for rule '{rule.name}' was not accepted")
+        except Exception as e:
+            print(f"Error sending command for rule '{rule.name}': {e}")
+        # Re-arm the rule, so its next evaluation sends the action again
+        with self.lock:
+            self.failed += 1
+            rule.active = None
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def stats(self):
+        return {
+            "rules": len(self.rules),
+            "indexed_dps": len(self.index),
+            "evaluations": self.evaluations,
+            "commands": self.commands,
+            "skipped": self.skipped,
+            "failed": self.failed
+        }
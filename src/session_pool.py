@@ -0,0 +1,142 @@
+import threading
+import time
+from collections import OrderedDict
+
+import tinytuya
+
+import sys
+import os
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config.settings import TUYA_SESSION_POOL_SIZE, TUYA_TOKEN_TTL, TUYA_TOKEN_REFRESH_MARGIN
+
+
+class TuyaSession:
+    """
+    A tinytuya.Cloud instance shared by every device that uses the same
+    (region, key, secret) credential set, together with its token age and usage counters.
+    """
+
+    def __init__(self, api_region, api_key, api_secret):
+        self.api_region = api_region
+        self.api_key = api_key
+        self.lock = threading.Lock()
+        self.cloud = tinytuya.Cloud(
+            apiRegion=api_region,
+            apiKey=api_key,
+            apiSecret=api_secret
+        )
+        self.token_issued_at = time.monotonic()
+        self.last_used = self.token_issued_at
+        self.hits = 0
+        self.misses = 1
+        self.refreshes = 0
+
+    def token_age(self):
+        return time.monotonic() - self.token_issued_at
+
+    def refresh_token(self):
+        # tinytuya has no public refresh call; _gettoken() re-runs the OAuth handshake in place
+        self.cloud._gettoken()
+        self.token_issued_at = time.monotonic()
+        self.refreshes += 1
+
+    def stats(self):
+        return {
+            "api_region": self.api_region,
+            "api_key": self.api_key,
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "token_age": round(self.token_age(), 1),
+            "idle": round(time.monotonic() - self.last_used, 1)
+        }
+
+
+class TuyaSessionPool:
+    """
+    Process-wide pool of authenticated tinytuya.Cloud sessions keyed by credentials.
+
+    Tokens are reused across devices and requests, refreshed proactively before
+    they expire and the least recently used credential set is evicted once the
+    pool is full.
+    """
+
+    def __init__(self, max_sessions=TUYA_SESSION_POOL_SIZE, token_ttl=TUYA_TOKEN_TTL,
+                 refresh_margin=TUYA_TOKEN_REFRESH_MARGIN):
+        self.max_sessions = max_sessions
+        self.token_ttl = token_ttl
+        self.refresh_margin = refresh_margin
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.misses = 0
+        self.evictions = 0
+
+    def get_session(self, api_region, api_key, api_secret):
+        key = (api_region, api_key, api_secret)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is not None:
+                self.sessions.move_to_end(key)
+                session.hits += 1
+
+        if session is None:
+            # Build outside the pool lock so one slow handshake doesn't block other credentials
+            new_session = TuyaSession(api_region, api_key, api_secret)
+            with self.lock:
+                session = self.sessions.get(key)
+                if session is None:
+                    session = new_session
+                    self.sessions[key] = session
+                    self.misses += 1
+                    self._evict()
+                else:
+                    session.hits += 1
+                self.sessions.move_to_end(key)
+
+        self._refresh_if_needed(session)
+        session.last_used = time.monotonic()
+        return session
+
+    def get_cloud(self, api_region, api_key, api_secret):
+        return self.get_session(api_region, api_key, api_secret).cloud
+
+    def _refresh_if_needed(self, session):
+        if session.token_age() < self.token_ttl - self.refresh_margin:
+            return
+        with session.lock:
+            # Another thread may have refreshed while we waited for the lock
+            if session.token_age() >= self.token_ttl - self.refresh_margin:
+                try:
+                    session.refresh_token()
+                except Exception as e:
+                    print(f"Error refreshing Tuya token for {session.api_key}: {e}")
+
+    def _evict(self):
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.sessions.clear()
+
+    def stats(self):
+        with self.lock:
+            sessions = [session.stats() for session in self.sessions.values()]
+            misses = self.misses
+            evictions = self.evictions
+        return {
+            "size": len(sessions),
+            "max_size": self.max_sessions,
+            "hits": sum(s["hits"] for s in sessions),
+            "misses": misses,
+            "refreshes": sum(s["refreshes"] for s in sessions),
+            "evictions": evictions,
+            "sessions": sessions
+        }
+
+
+# Shared by every TuyaDeviceManager in the process
+session_pool = TuyaSessionPool()
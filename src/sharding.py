@@ -0,0 +1,108 @@
+import bisect
+import hashlib
+import socket
+import time
+
+import sys
+import os
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config.settings import SHARD_LEASE_TTL, SHARD_VNODES
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring with virtual nodes. Adding or removing a node only moves
+    the keys of that node (about 1/N of them), everything else keeps its owner.
+    """
+
+    def __init__(self, nodes=(), vnodes=SHARD_VNODES):
+        self.vnodes = vnodes
+        self.nodes = sorted(set(nodes))
+        self._ring = sorted((ring_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in self._ring]
+
+    def owner(self, key):
+        if not self._ring:
+            return None
+        i = bisect.bisect(self._hashes, ring_hash(key)) % len(self._ring)
+        return self._ring[i][1]
+
+
+class ShardCoordinator:
+    """
+    Membership of the updater fleet, coordinated through a Mongo collection.
+
+    Every node renews a lease (its heartbeat document) every SHARD_HEARTBEAT_INTERVAL
+    seconds and reads back the nodes whose lease is still valid. The live nodes form
+    the hash ring; a node owns the devices whose ID hashes to it. When a node joins,
+    leaves or stops heartbeating, every node sees the new membership on its next
+    heartbeat and rebalances.
+
+    A node that can't renew its lease for lease_ttl seconds has been dropped from the
+    ring by the others, so it stops owning anything until a heartbeat succeeds again.
+    """
+
+    def __init__(self, db_client, node_id=None, lease_ttl=SHARD_LEASE_TTL, vnodes=SHARD_VNODES):
+        self.db_client = db_client
+        self.node_id = node_id or os.getenv('SHARD_NODE_ID') or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_ttl = lease_ttl
+        self.vnodes = vnodes
+        # Empty until the first heartbeat, so a starting node doesn't poll everything
+        self.ring = HashRing(vnodes=vnodes)
+        self.rebalances = 0
+        self.renewed_at = None
+        self.expired = False
+
+    def heartbeat(self):
+        """
+        Renew this node's lease and pick up membership changes.
+
+        Returns:
+        bool: True if the membership changed, or the lease expired or was renewed after expiring,
+        and devices have to be rebalanced.
+        """
+        # Taken before the renewal, so the lease never outlives the one the other nodes see
+        started = time.monotonic()
+        members = self.db_client.heartbeat_node(self.node_id, self.lease_ttl)
+        if members is None:
+            # Keep the current assignment while Mongo is unreachable, until the lease runs out
+            if self.expired or not self.lease_expired():
+                return False
+            print(f"Shard lease of {self.node_id} expired, releasing all devices")
+            self.expired = True
+            return True
+        self.renewed_at = started
+        recovered, self.expired = self.expired, False
+        members = sorted(set(members) | {self.node_id})
+        if members == self.ring.nodes:
+            return recovered
+        print(f"Shard membership changed, {len(members)} nodes: {', '.join(members)}")
+        self.ring = HashRing(members, self.vnodes)
+        self.rebalances += 1
+        return True
+
+    def lease_expired(self):
+        return self.renewed_at is None or time.monotonic() - self.renewed_at > self.lease_ttl
+
+    def owns(self, device_id):
+        return not self.lease_expired() and self.ring.owner(device_id) == self.node_id
+
+    def leave(self):
+        """
+        Give up the lease so the other nodes take over this node's devices right away.
+        """
+        self.db_client.remove_node(self.node_id)
+
+    def stats(self):
+        return {
+            "node_id": self.node_id,
+            "nodes": self.ring.nodes,
+            "rebalances": self.rebalances,
+            "lease_expired": self.lease_expired()
+        }
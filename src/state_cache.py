@@ -0,0 +1,121 @@
+import hashlib
+import json
+import threading
+import time
+
+import sys
+import os
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.change_detection import result_to_map, changed_codes
+
+
+def hash_values(values):
+    """
+    Cheap, order-insensitive content hash of a code -> value dict, used as a fast path before the per-DP compare.
+    """
+    encoded = json.dumps(values, sort_keys=True, default=str).encode()
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+
+class DeviceState:
+    def __init__(self, values):
+        self.values = values
+        self.hash = hash_values(values)
+        self.keyframe_at = time.monotonic()
+
+
+class LastValueCache:
+    """
+    In-process last stored state per device, so change detection doesn't read Mongo on every poll.
+
+    The values are the reference for deadbands: they only move when a DP is actually stored,
+    so slow drift below the deadband still adds up to a change eventually.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def warm(self, db_client):
+        # One aggregate query for every device instead of a find_one per device per poll
+        records = db_client.get_latest_records()
+        for device_id, data in records.items():
+            if data and data.get('delta'):
+                # Latest document only carries the changed DPs, rebuild the full state from its keyframe
+                data = db_client.get_latest_record(device_id)
+            self.set(device_id, data)
+        print(f"Warmed last-value cache with {len(records)} devices")
+
+    def get(self, device_id):
+        with self.lock:
+            entry = self.entries.get(device_id)
+            return dict(entry.values) if entry else None
+
+    def set(self, device_id, status):
+        """
+        Replace the stored state with a full status (a keyframe).
+        """
+        if not status or 'result' not in status:
+            return
+        with self.lock:
+            self.entries[device_id] = DeviceState(result_to_map(status['result']))
+
+    def update(self, device_id, status):
+        """
+        Merge the DPs of a stored (possibly delta) status into the stored state.
+        """
+        if not status or 'result' not in status:
+            return
+        with self.lock:
+            entry = self.entries.get(device_id)
+            if entry is None or not status.get('delta'):
+                self.entries[device_id] = DeviceState(result_to_map(status['result']))
+                return
+            values = dict(entry.values)
+            values.update(result_to_map(status['result']))
+            keyframe_at = entry.keyframe_at
+            entry = DeviceState(values)
+            entry.keyframe_at = keyframe_at
+            self.entries[device_id] = entry
+
+    def changes(self, device_id, new_status):
+        """
+        DPs of new_status that differ from the stored state, as a code -> value dict.
+        """
+        values = result_to_map(new_status['result'])
+        with self.lock:
+            entry = self.entries.get(device_id)
+        if entry is None:
+            return values
+        if entry.hash == hash_values(values):
+            return {}
+        return changed_codes(entry.values, values)
+
+    def has_changed(self, device_id, new_status):
+        return bool(self.changes(device_id, new_status))
+
+    def keyframe_due(self, device_id, interval):
+        with self.lock:
+            entry = self.entries.get(device_id)
+        return entry is None or time.monotonic() - entry.keyframe_at >= interval
+
+    def discard(self, device_id):
+        """
+        Forget the stored state of a device, so it is read from Mongo again before its next comparison.
+        """
+        with self.lock:
+            self.entries.pop(device_id, None)
+
+    def __contains__(self, device_id):
+        with self.lock:
+            return device_id in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+
+# Shared by the change detection in this process
+last_values = LastValueCache()
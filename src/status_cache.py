@@ -0,0 +1,65 @@
+import threading
+import time
+
+import sys
+import os
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config.settings import STATUS_CACHE_MAX_ENTRIES
+
+
+class StatusCache:
+    """
+    Recently fetched device statuses for the API, keyed by credentials and device ID
+    so a status is only served to callers that could have fetched it themselves.
+    """
+
+    def __init__(self, max_entries=STATUS_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, credentials, device_id, max_age):
+        """
+        Returns (status, age in seconds) if a status younger than max_age is cached, else None.
+        """
+        with self.lock:
+            entry = self.entries.get((credentials, device_id))
+            if entry is not None:
+                status, fetched_at = entry
+                age = time.time() - fetched_at
+                if age <= max_age:
+                    self.hits += 1
+                    return status, age
+            self.misses += 1
+            return None
+
+    def verified(self, credentials, device_id):
+        """
+        Whether these credentials have fetched this device live, at any age, so the
+        poller's stored status of it may be served to them.
+        """
+        with self.lock:
+            return (credentials, device_id) in self.entries
+
+    def put(self, credentials, device_id, status, fetched_at=None):
+        if not status or not status.get('success'):
+            return
+        key = (credentials, device_id)
+        with self.lock:
+            # Re-inserted so the entry moves to the end; only a new key can overflow the cache
+            if self.entries.pop(key, None) is None and len(self.entries) >= self.max_entries:
+                # Drop the oldest entry; dicts keep insertion order
+                self.entries.pop(next(iter(self.entries)))
+            self.entries[key] = (status, fetched_at or time.time())
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+# Shared by the API endpoints in this process
+status_cache = StatusCache()
@@ -0,0 +1,235 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import re
+import time
+from collections import OrderedDict
+
+import httpx
+
+import sys
+import os
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config.settings import (TUYA_ASYNC_MAX_CONNECTIONS, TUYA_ASYNC_MAX_KEEPALIVE, TUYA_ASYNC_TIMEOUT,
+                             TUYA_SESSION_POOL_SIZE, TUYA_TOKEN_REFRESH_MARGIN)
+from src.rate_limiter import get_rate_limiter, rate_limited_response
+from src.metrics import tuya_call_seconds, tuya_rate_limit_wait_seconds
+
+# Same region -> host mapping as tinytuya.Cloud
+TUYA_API_HOSTS = {
+    "cn": "openapi.tuyacn.com",
+    "us": "openapi.tuyaus.com",
+    "us-e": "openapi-ueaz.tuyaus.com",
+    "eu": "openapi.tuyaeu.com",
+    "eu-w": "openapi-weaz.tuyaeu.com",
+    "in": "openapi.tuyain.com",
+}
+
+# Tuya error codes meaning the access token is no longer valid
+TOKEN_INVALID_CODES = (1010, 1011)
+
+
+# The API path each tinytuya.Cloud method calls, so the blocking and async clients label the same call alike
+CLOUD_METHOD_ENDPOINTS = {
+    "getstatus": "/v1.0/iot-03/devices/{device_id}/status",
+    "sendcommand": "/v1.0/iot-03/devices/{device_id}/commands",
+    "getproperties": "/v1.0/devices/{device_id}/specifications",
+    "getfunctions": "/v1.0/iot-03/devices/{device_id}/functions",
+    "getdevicelog": "/v1.0/devices/{device_id}/logs",
+}
+
+
+def endpoint_label(path):
+    """
+    Metrics label of a Tuya API path, with the device ID taken out so the label stays low-cardinality.
+    """
+    return re.sub(r"/devices/[^/]+/", "/devices/{device_id}/", path)
+
+
+def cloud_method_label(name, args):
+    """
+    Metrics label of a tinytuya.Cloud method call, the same as endpoint_label() of the path it requests.
+    Methods without a known path keep their name.
+    """
+    if name == "cloudrequest":
+        return endpoint_label(args[0])
+    return CLOUD_METHOD_ENDPOINTS.get(name, name)
+
+
+def sign_request(api_key, api_secret, t, method, url, body="", token=""):
+    """
+    Tuya's HMAC-SHA256 request signature (the post 2021 algorithm tinytuya also uses).
+    url is the path plus the sorted, not URL-encoded, query string.
+    """
+    content_hash = hashlib.sha256(body.encode()).hexdigest()
+    string_to_sign = f"{method}\n{content_hash}\n\n{url}"
+    payload = api_key + token + t + string_to_sign
+    return hmac.new(api_secret.encode(), payload.encode(), hashlib.sha256).hexdigest().upper()
+
+
+class AsyncTuyaCloud:
+    """
+    Native asyncio counterpart of the tinytuya.Cloud calls the API server makes.
+
+    One httpx.AsyncClient, and so one keep-alive connection pool, is shared by every
+    credential set. Access tokens are cached per credential set and renewed under a
+    per-credential lock, so concurrent requests share one handshake. Calls go through
+    the same per-process token buckets as the blocking client, and identical GETs
+    already in flight are joined instead of repeated.
+    """
+
+    def __init__(self, max_connections=TUYA_ASYNC_MAX_CONNECTIONS, max_keepalive=TUYA_ASYNC_MAX_KEEPALIVE,
+                 timeout=TUYA_ASYNC_TIMEOUT, max_tokens=TUYA_SESSION_POOL_SIZE):
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        self.timeout = timeout
+        self.max_tokens = max_tokens
+        self.client = None
+        self.tokens = OrderedDict()
+        self.token_locks = {}
+        self.in_flight = {}
+        self.requests = 0
+        self.coalesced = 0
+        self.token_refreshes = 0
+
+    def _client(self):
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+        return self.client
+
+    async def _send(self, credentials, method, path, query=None, body=None, token=""):
+        api_region, api_key, api_secret = credentials
+        # The signature is computed over the raw query string, before URL-encoding
+        query = sorted((query or {}).items())
+        url = path + ("?" + "&".join(f"{key}={value}" for key, value in query) if query else "")
+        content = json.dumps(body) if body is not None else ""
+        t = str(int(time.time() * 1000))
+        headers = {
+            "client_id": api_key,
+            "sign": sign_request(api_key, api_secret, t, method, url, content, token),
+            "t": t,
+            "sign_method": "HMAC-SHA256",
+            "Content-Type": "application/json",
+        }
+        if token:
+            headers["access_token"] = token
+
+        self.requests += 1
+        with tuya_call_seconds.time(client="async", endpoint=endpoint_label(path)):
+            response = await self._client().request(
+                method, f"https://{TUYA_API_HOSTS[api_region]}{path}",
+                params=query, content=content or None, headers=headers
+            )
+        return response.json()
+
+    async def get_token(self, credentials):
+        cached = self.tokens.get(credentials)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+
+        lock = self.token_locks.setdefault(credentials, asyncio.Lock())
+        async with lock:
+            # Another request may have renewed the token while we waited for the lock
+            cached = self.tokens.get(credentials)
+            if cached is not None and cached[1] > time.monotonic():
+                return cached[0]
+            result = await self._send(credentials, "GET", "/v1.0/token", {"grant_type": 1})
+            if not result.get("success"):
+                raise ConnectionError(f"Tuya token request failed: {result.get('msg')}")
+            token = result["result"]["access_token"]
+            expires_at = time.monotonic() + result["result"]["expire_time"] - TUYA_TOKEN_REFRESH_MARGIN
+            self.tokens[credentials] = (token, expires_at)
+            self.tokens.move_to_end(credentials)
+            while len(self.tokens) > self.max_tokens:
+                evicted, _ = self.tokens.popitem(last=False)
+                self.token_locks.pop(evicted, None)
+            self.token_refreshes += 1
+            return token
+
+    async def _request(self, credentials, method, path, query=None, body=None):
+        api_region, api_key, _ = credentials
+        for attempt in range(2):
+            token = await self.get_token(credentials)
+            limiter = get_rate_limiter(api_region, api_key)
+            delay = limiter.reserve()
+            if delay is None:
+                return rate_limited_response()
+            tuya_rate_limit_wait_seconds.observe(delay, client="async")
+            if delay > 0:
+                try:
+                    await asyncio.sleep(delay)
+                except asyncio.CancelledError:
+                    # The request was never sent, its slot goes to the next caller
+                    limiter.refund()
+                    raise
+            result = await self._send(credentials, method, path, query, body, token)
+            # A token revoked before its expiry is renewed once
+            if attempt or result.get("success") or result.get("code") not in TOKEN_INVALID_CODES:
+                return result
+            self.tokens.pop(credentials, None)
+
+    async def request(self, credentials, method, path, query=None, body=None, coalesce=False):
+        """
+        Signed Tuya OpenAPI request.
+
+        Args:
+        credentials: (api_region, api_key, api_secret).
+        method: HTTP method.
+        path: API path, e.g. '/v1.0/iot-03/devices/{id}/status'.
+        query: Optional query parameters.
+        body: Optional JSON body.
+        coalesce: Join an identical request already in flight instead of sending another one.
+
+        Returns:
+        dict: The decoded Tuya response ({'result', 'success', 't', ...}).
+        """
+        if not coalesce:
+            return await self._request(credentials, method, path, query, body)
+
+        key = (credentials, method, path, json.dumps(query, sort_keys=True), json.dumps(body, sort_keys=True))
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = self.in_flight[key] = asyncio.ensure_future(self._request(credentials, method, path, query, body))
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        # Shielded so one cancelled caller doesn't cancel the call the others are waiting on
+        return await asyncio.shield(task)
+
+    async def getstatus(self, credentials, device_id):
+        return await self.request(credentials, "GET", f"/v1.0/iot-03/devices/{device_id}/status", coalesce=True)
+
+    async def getstatus_batch(self, credentials, device_ids):
+        return await self.request(
+            credentials, "GET", "/v1.0/iot-03/devices/status",
+            query={"device_ids": ",".join(device_ids)}, coalesce=True
+        )
+
+    async def sendcommand(self, credentials, device_id, commands):
+        return await self.request(credentials, "POST", f"/v1.0/iot-03/devices/{device_id}/commands", body=commands)
+
+    async def getproperties(self, credentials, device_id):
+        return await self.request(credentials, "GET", f"/v1.0/devices/{device_id}/specifications", coalesce=True)
+
+    async def getfunctions(self, credentials, device_id):
+        return await self.request(credentials, "GET", f"/v1.0/iot-03/devices/{device_id}/functions", coalesce=True)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "coalesced": self.coalesced,
+            "in_flight": len(self.in_flight),
+            "tokens": len(self.tokens),
+            "token_refreshes": self.token_refreshes
+        }
+
+
+# Shared by every TuyaDeviceManager in the process
+async_cloud = AsyncTuyaCloud()
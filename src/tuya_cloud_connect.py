@@ -1,4 +1,3 @@
-import tinytuya
 import socket
 import requests
 from ip2geotools.databases.noncommercial import DbIpCity
@@ -13,19 +12,57 @@ import pytz
 # Add the project directory to the system path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config.settings import *
+from src.session_pool import session_pool
+from src.local_control import local_router
+from src.rate_limiter import get_rate_limiter, rate_limited_response, single_flight
+from src.tuya_async_client import async_cloud, cloud_method_label
+from src.metrics import tuya_call_seconds, tuya_rate_limit_wait_seconds
+from src.weather_cache import geo_weather_cache
+import asyncio
+import json
+import threading
+import time
 from urllib.parse import urlencode
 
 # Retrieve API credentials from environment variables
 WEATHER_API_KEY = os.getenv('WEATHER_API_KEY')
 
+# Function specs per (credentials, device ID) -> (functions, fetched_at); they only change with firmware
+device_metadata = {}
+device_metadata_lock = threading.Lock()
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def batch_statuses(device_ids, result):
+    """
+    Split one batch status response into per-device statuses shaped like get_status().
+    Devices the API didn't return get a {'success': False, ...} entry.
+    """
+    if not result or not result.get('success'):
+        print(f"Failed to retrieve batch status: {result}")
+        return {device_id: result or {'success': False, 'msg': 'No response'} for device_id in device_ids}
+
+    statuses = {
+        item['id']: {
+            'result': item.get('status', []),
+            'success': True,
+            't': result.get('t'),
+            'tid': result.get('tid')
+        }
+        for item in result.get('result', [])
+    }
+    for device_id in device_ids:
+        if device_id not in statuses:
+            statuses[device_id] = {'success': False, 'msg': 'Device missing from batch response'}
+    return statuses
+
 class TuyaDeviceManager:
-    def __init__(self, api_region, api_key, api_secret, api_device_id, ip=None):
-        self.cloud = tinytuya.Cloud(
-            apiRegion=api_region, 
-            apiKey=api_key, 
-            apiSecret=api_secret, 
-            apiDeviceID=api_device_id
-        )
+    def __init__(self, api_region, api_key, api_secret, api_device_id, ip=None, pool=session_pool):
+        # Cloud sessions are shared per credential set, so creating a manager doesn't re-authenticate
+        self.pool = pool
+        self.credentials = (api_region, api_key, api_secret)
         self.weather_api_key = WEATHER_API_KEY
         self.device_id = api_device_id
         self.ip = ip
@@ -40,9 +77,70 @@ class TuyaDeviceManager:
         self.timezone = TIMEZONE
         self.weather_api_key = WEATHER_API_KEY 
 
-    def get_functions(self):
-        result = self.cloud.getfunctions(self.device_id)
+    @property
+    def cloud(self):
+        return self.pool.get_cloud(*self.credentials)
+
+    def cloud_call(self, name, *args, coalesce=False, **kwargs):
+        """
+        Call a tinytuya.Cloud method under the credential set's rate limit.
+        With coalesce, identical calls already in flight are joined instead of repeated.
+        """
+        api_region, api_key, _ = self.credentials
+        endpoint = cloud_method_label(name, args)
+
+        def call():
+            delay = get_rate_limiter(api_region, api_key).reserve()
+            if delay is None:
+                return rate_limited_response()
+            tuya_rate_limit_wait_seconds.observe(delay, client="sync")
+            if delay > 0:
+                time.sleep(delay)
+            with tuya_call_seconds.time(client="sync", endpoint=endpoint):
+                return getattr(self.cloud, name)(*args, **kwargs)
+
+        if not coalesce:
+            return call()
+        key = (api_region, api_key, name, json.dumps([args, kwargs], sort_keys=True, default=str))
+        return single_flight.do(key, call)
+
+    def get_function_specs(self, max_age=DEVICE_METADATA_TTL):
+        """
+        The device's function specs (code, type, values), cached for max_age seconds.
+        """
+        key = (self.credentials, self.device_id)
+        cached = self.cached_function_specs(max_age)
+        if cached is not None:
+            return cached
+        result = self.cloud_call('getfunctions', self.device_id, coalesce=True)
+        if not result or not result.get('success'):
+            print("Failed to retrieve functions")
+            return None
         functions = result['result']['functions']
+        with device_metadata_lock:
+            device_metadata[key] = (functions, time.time())
+        return functions
+
+    def cached_function_specs(self, max_age=DEVICE_METADATA_TTL):
+        with device_metadata_lock:
+            cached = device_metadata.get((self.credentials, self.device_id))
+        if cached is not None and time.time() - cached[1] < max_age:
+            return cached[0]
+        return None
+
+    def unknown_command_codes(self, commands):
+        """
+        Command codes the device doesn't support, checked against cached function specs only
+        so validation never costs an extra API call. Empty if nothing is cached yet.
+        """
+        functions = self.cached_function_specs()
+        if functions is None:
+            return []
+        codes = {function['code'] for function in functions}
+        return [command['code'] for command in commands.get('commands', []) if command.get('code') not in codes]
+
+    def get_functions(self):
+        functions = self.get_function_specs()
         print("Functions of device:")
         for func in functions:
             print(f"  Code: {func['code']}")
@@ -55,7 +153,8 @@ class TuyaDeviceManager:
     def get_location(self):
         try:
             if self.ip is not None:
-                location = DbIpCity.get(self.ip, api_key="free")
+                # Looked up once per IP for the whole process, not once per manager
+                location = geo_weather_cache.get_location(self.ip, lambda ip: DbIpCity.get(ip, api_key="free"))
                 self._set_location(location)
                 return location
             else:
@@ -79,29 +178,35 @@ class TuyaDeviceManager:
             else:
                 print("Failed to get location")
                 return None
+        parameters = {
+            "fields": ','.join(self.fields),
+            "units": self.units,
+            "timesteps": ','.join(self.timesteps),
+            "timezone": self.timezone,
+        }
         try:
-            parameters = {
-                "apikey": self.weather_api_key,
-                "location": ','.join(map(str, [self.lat, self.lon])),
-                "fields": ','.join(self.fields),
-                "units": self.units,
-                "timesteps": ','.join(self.timesteps),
-                "timezone": self.timezone,
-            }
-            full_url = f"{self.url}?{urlencode(parameters)}"
-            response = requests.get(full_url)
-
-            if response.status_code == 200:
-                return response.json()
-            else:
-                print(f"Error: {response.status_code}, {response.text}")
-                return None
+            # Devices in the same grid cell share one cached forecast
+            return geo_weather_cache.get_weather(
+                self.lat, self.lon, parameters, lambda lat, lon: self._fetch_weather(lat, lon, parameters)
+            )
         except Exception as e:
             print(f"Error fetching weather data: {e}")
             return None
+
+    def _fetch_weather(self, lat, lon, parameters):
+        parameters = dict(parameters, apikey=self.weather_api_key, location=','.join(map(str, [lat, lon])))
+        full_url = f"{self.url}?{urlencode(parameters)}"
+        response = requests.get(full_url)
+
+        if response.status_code == 200:
+            return response.json()
+        else:
+            print(f"Error: {response.status_code}, {response.text}")
+            return None
         
     def send_command(self, commands):
-        result = self.cloud.sendcommand(self.device_id, commands)
+        # Devices configured for local control are commanded over the LAN, with the cloud as fallback
+        result = local_router.call(self, 'send_command', self._cloud_send_command, commands)
         if result['success']:
             return result
         else:
@@ -109,10 +214,10 @@ class TuyaDeviceManager:
             return None
         
     def get_device_information(self):
-        return self.cloud.get_device_info(self.device_id)
+        return self.cloud_call('get_device_info', self.device_id, coalesce=True)
 
     def get_devices_list(self):
-        devices = self.cloud.getdevices()
+        devices = self.cloud_call('getdevices', coalesce=True)
         for device in devices:
             print(f"Name: {device['name']}")
             print(f"ID: {device['id']}")
@@ -125,7 +230,7 @@ class TuyaDeviceManager:
         return devices
 
     def get_properties(self):
-        result = self.cloud.getproperties(self.device_id)
+        result = self.cloud_call('getproperties', self.device_id, coalesce=True)
         if result['success']:
             return result
         else:
@@ -133,11 +238,100 @@ class TuyaDeviceManager:
             return None
 
     def get_status(self):
-        result = self.cloud.getstatus(self.device_id)
+        result = local_router.call(self, 'get_status', self._cloud_get_status)
         return result
 
+    def _cloud_get_status(self):
+        return self.cloud_call('getstatus', self.device_id, coalesce=True)
+
+    def _cloud_send_command(self, commands):
+        return self.cloud_call('sendcommand', self.device_id, commands)
+
+    def get_status_batch(self, device_ids):
+        """
+        Read the status of many devices that share this manager's credentials,
+        one request per TUYA_STATUS_BATCH_SIZE devices.
+
+        Returns a dict of device_id -> status shaped like get_status(), see batch_statuses().
+        """
+        statuses = {}
+        device_ids = list(device_ids)
+
+        # Devices under local control are read over the LAN, the rest share batch calls
+        for device_id in [device_id for device_id in device_ids if local_router.handles(device_id)]:
+            device = TuyaDeviceManager(*self.credentials, device_id, pool=self.pool)
+            statuses[device_id] = device.get_status()
+        device_ids = [device_id for device_id in device_ids if device_id not in statuses]
+
+        for chunk in chunked(device_ids, TUYA_STATUS_BATCH_SIZE):
+            result = self.cloud_call(
+                'cloudrequest',
+                '/v1.0/iot-03/devices/status',
+                query={'device_ids': ','.join(chunk)},
+                coalesce=True
+            )
+            statuses.update(batch_statuses(chunk, result))
+        return statuses
+
+    # Async variants for the API server: cloud calls go through the shared httpx pool and never
+    # block the event loop. Locally routed devices keep the tinytuya path in a worker thread.
+
+    async def async_get_status(self):
+        if local_router.handles(self.device_id):
+            return await asyncio.to_thread(self.get_status)
+        return await async_cloud.getstatus(self.credentials, self.device_id)
+
+    async def async_send_command(self, commands):
+        if local_router.handles(self.device_id):
+            return await asyncio.to_thread(self.send_command, commands)
+        result = await async_cloud.sendcommand(self.credentials, self.device_id, commands)
+        if result.get('success'):
+            return result
+        else:
+            print("Failed to send command")
+            return None
+
+    async def async_get_properties(self):
+        result = await async_cloud.getproperties(self.credentials, self.device_id)
+        if result.get('success'):
+            return result
+        else:
+            print("Failed to retrieve properties")
+            return None
+
+    async def async_get_function_specs(self, max_age=DEVICE_METADATA_TTL):
+        cached = self.cached_function_specs(max_age)
+        if cached is not None:
+            return cached
+        result = await async_cloud.getfunctions(self.credentials, self.device_id)
+        if not result or not result.get('success'):
+            print("Failed to retrieve functions")
+            return None
+        functions = result['result']['functions']
+        with device_metadata_lock:
+            device_metadata[(self.credentials, self.device_id)] = (functions, time.time())
+        return functions
+
+    async def async_get_status_batch(self, device_ids):
+        """
+        Async get_status_batch(): the chunks are read concurrently.
+        """
+        statuses = {}
+        device_ids = list(device_ids)
+
+        local_ids = [device_id for device_id in device_ids if local_router.handles(device_id)]
+        if local_ids:
+            statuses.update(await asyncio.to_thread(self.get_status_batch, local_ids))
+        device_ids = [device_id for device_id in device_ids if device_id not in statuses]
+
+        chunks = list(chunked(device_ids, TUYA_STATUS_BATCH_SIZE))
+        results = await asyncio.gather(*[async_cloud.getstatus_batch(self.credentials, chunk) for chunk in chunks])
+        for chunk, result in zip(chunks, results):
+            statuses.update(batch_statuses(chunk, result))
+        return statuses
+
     def get_device_logs(self, start=None, end=None):
-        result = self.cloud.getdevicelog(self.device_id, start=start, end=end)
+        result = self.cloud_call('getdevicelog', self.device_id, start=start, end=end)
         print("Device logs:")
         for log in result['result']['logs']:
             print(f"  Event Time: {log['event_time']}")
@@ -0,0 +1,189 @@
+import json
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+import sys
+import os
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config.settings import GEOLOCATION_TTL, WEATHER_GRID_DECIMALS, WEATHER_TTL_BY_TIMESTEP, WEATHER_CACHE_PATH
+from src.rate_limiter import SingleFlight
+
+# The parts of ip2geotools' IpLocation the managers use
+Location = namedtuple("Location", ["latitude", "longitude", "city", "region", "country"])
+
+
+def weather_ttl(timesteps):
+    """
+    How long a forecast stays valid: the finest of the requested timesteps decides.
+    """
+    return min(WEATHER_TTL_BY_TIMESTEP.get(timestep, WEATHER_TTL_BY_TIMESTEP["current"]) for timestep in timesteps)
+
+
+class GeoWeatherCache:
+    """
+    Process-wide cache of geolocation and weather lookups, shared by every TuyaDeviceManager.
+
+    IP -> location results are kept for GEOLOCATION_TTL. Weather is cached per grid cell
+    (lat/lon rounded to WEATHER_GRID_DECIMALS) and request parameters, for as long as the
+    requested timesteps allow, so devices at one site share a single forecast. Concurrent
+    misses for the same key share one fetch. With a path, the cache is kept on disk so a
+    restart doesn't spend API quota again.
+    """
+
+    def __init__(self, path=WEATHER_CACHE_PATH, grid_decimals=WEATHER_GRID_DECIMALS, location_ttl=GEOLOCATION_TTL):
+        self.path = path
+        self.grid_decimals = grid_decimals
+        self.location_ttl = location_ttl
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.flights = SingleFlight()
+        self.locations = {}
+        self.weather = {}
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self._load()
+
+    def _load(self):
+        self.locations, self.weather = self._read()
+
+    def _read(self):
+        try:
+            with open(self.path) as cache_file:
+                stored = json.load(cache_file)
+        except FileNotFoundError:
+            return {}, {}
+        except Exception as e:
+            print(f"Error reading weather cache: {e}")
+            return {}, {}
+        locations = {ip: (Location(*location), fetched_at) for ip, (location, fetched_at) in stored.get("locations", {}).items()}
+        weather = {key: tuple(entry) for key, entry in stored.get("weather", {}).items()}
+        return locations, weather
+
+    def _merge(self, locations, weather):
+        # Unexpired entries another process saved are kept, the newer fetch wins on a shared key
+        now = time.time()
+        for ip, entry in locations.items():
+            if now - entry[1] < self.location_ttl and entry[1] > self.locations.get(ip, (None, 0))[1]:
+                self.locations[ip] = entry
+        for key, entry in weather.items():
+            if now - entry[1] < entry[2] and entry[1] > self.weather.get(key, (None, 0, 0))[1]:
+                self.weather[key] = entry
+
+    def _save(self):
+        if not self.path:
+            return
+        # Saves are serialized so an older snapshot never replaces a newer one
+        with self.save_lock:
+            # The API server and the updater share the file, so what the other one saved since is merged in
+            locations, weather = self._read()
+            with self.lock:
+                self._merge(locations, weather)
+                stored = {
+                    "locations": {
+                        ip: [list(location), fetched_at] for ip, (location, fetched_at) in self.locations.items()
+                    },
+                    "weather": {key: list(entry) for key, entry in self.weather.items()}
+                }
+            # Write then rename so a crash never leaves a truncated cache file; each save
+            # writes its own temp file in the same directory.
+            directory = os.path.dirname(self.path) or "."
+            temp_path = None
+            try:
+                os.makedirs(directory, mode=0o700, exist_ok=True)
+                fd, temp_path = tempfile.mkstemp(prefix=".weather_cache.", dir=directory)
+                with os.fdopen(fd, "w") as cache_file:
+                    json.dump(stored, cache_file)
+                os.replace(temp_path, self.path)
+            except Exception as e:
+                print(f"Error writing weather cache: {e}")
+                if temp_path and os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+    def get_location(self, ip, lookup):
+        """
+        The location of an IP address.
+
+        Args:
+        ip: IP address.
+        lookup: Called with the IP on a miss, returns an object with latitude/longitude (and city, region, country).
+
+        Returns:
+        Location: The cached or freshly looked up location.
+        """
+        with self.lock:
+            cached = self.locations.get(ip)
+        if cached is not None and time.time() - cached[1] < self.location_ttl:
+            self.hits += 1
+            return cached[0]
+        self.misses += 1
+        return self.flights.do(("location", ip), self._lookup_location, ip, lookup)
+
+    def _lookup_location(self, ip, lookup):
+        result = lookup(ip)
+        location = Location(
+            result.latitude,
+            result.longitude,
+            getattr(result, "city", None),
+            getattr(result, "region", None),
+            getattr(result, "country", None)
+        )
+        with self.lock:
+            self.locations[ip] = (location, time.time())
+        self._save()
+        return location
+
+    def get_weather(self, lat, lon, parameters, fetch):
+        """
+        Weather for the grid cell containing (lat, lon).
+
+        Args:
+        lat: Latitude.
+        lon: Longitude.
+        parameters: Request parameters other than the location and API key (fields, units, timesteps, timezone).
+        fetch: Called as fetch(cell_lat, cell_lon) on a miss, returns the response data or None on failure.
+
+        Returns:
+        dict: The weather data, or None if it couldn't be fetched.
+        """
+        cell = (round(lat, self.grid_decimals), round(lon, self.grid_decimals))
+        key = json.dumps([cell, parameters], sort_keys=True)
+        ttl = weather_ttl(parameters["timesteps"].split(","))
+        with self.lock:
+            cached = self.weather.get(key)
+        if cached is not None and time.time() - cached[1] < ttl:
+            self.hits += 1
+            return cached[0]
+        self.misses += 1
+        return self.flights.do(("weather", key), self._fetch_weather, key, cell, ttl, fetch)
+
+    def _fetch_weather(self, key, cell, ttl, fetch):
+        data = fetch(*cell)
+        if data is None:
+            # Failures aren't cached, the next call tries again
+            return None
+        now = time.time()
+        with self.lock:
+            self.weather[key] = (data, now, ttl)
+            # Expired cells are dropped whenever something new is stored
+            self.weather = {k: entry for k, entry in self.weather.items() if now - entry[1] < entry[2]}
+        self._save()
+        return data
+
+    def stats(self):
+        with self.lock:
+            return {
+                "locations": len(self.locations),
+                "weather_cells": len(self.weather),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.flights.coalesced
+            }
+
+
+# Shared by every TuyaDeviceManager in the process
+geo_weather_cache = GeoWeatherCache()
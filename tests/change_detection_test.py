@@ -0,0 +1,80 @@
+import sys
+import os
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.change_detection import changed_codes, delta_status, map_to_result, result_to_map
+from src.state_cache import LastValueCache
+
+DEADBANDS = {"temp_current": 5}
+
+
+def status(**values):
+    return {"success": True, "t": 1, "result": map_to_result(values)}
+
+
+def test_changed_codes_ignores_dp_order():
+    previous = {"switch": True, "temp_current": 210}
+    assert changed_codes(previous, {"temp_current": 210, "switch": True}, DEADBANDS) == {}
+
+
+def test_changed_codes_without_previous_returns_everything():
+    assert changed_codes(None, {"switch": True}, DEADBANDS) == {"switch": True}
+
+
+def test_changed_codes_deadband():
+    previous = {"temp_current": 210, "humidity": 40}
+    # Within the deadband: not a change; past it: a change
+    assert changed_codes(previous, {"temp_current": 215, "humidity": 40}, DEADBANDS) == {}
+    assert changed_codes(previous, {"temp_current": 216, "humidity": 40}, DEADBANDS) == {"temp_current": 216}
+    # Codes without a deadband change on any difference
+    assert changed_codes(previous, {"temp_current": 210, "humidity": 41}, DEADBANDS) == {"humidity": 41}
+
+
+def test_changed_codes_deadband_only_applies_to_numbers():
+    assert changed_codes({"temp_current": 210}, {"temp_current": "210"}, DEADBANDS) == {"temp_current": "210"}
+    assert changed_codes({"temp_current": True}, {"temp_current": False}, DEADBANDS) == {"temp_current": False}
+
+
+def test_changed_codes_new_code_is_a_change():
+    assert changed_codes({"switch": True}, {"switch": True, "countdown": 0}, DEADBANDS) == {"countdown": 0}
+
+
+def test_delta_status_carries_only_the_changes():
+    delta = delta_status(status(switch=True, temp_current=210), {"temp_current": 210})
+    assert delta["delta"] is True
+    assert delta["t"] == 1
+    assert result_to_map(delta["result"]) == {"temp_current": 210}
+
+
+def test_delta_merges_onto_the_keyframe():
+    cache = LastValueCache()
+    cache.set("device", status(switch=True, temp_current=210))
+    cache.update("device", delta_status(status(), {"temp_current": 230}))
+    assert cache.get("device") == {"switch": True, "temp_current": 230}
+
+
+def test_delta_keeps_the_keyframe_time():
+    cache = LastValueCache()
+    cache.set("device", status(switch=True))
+    keyframe_at = cache.entries["device"].keyframe_at
+    cache.update("device", delta_status(status(), {"switch": False}))
+    assert cache.entries["device"].keyframe_at == keyframe_at
+    assert not cache.keyframe_due("device", 3600)
+    assert cache.keyframe_due("device", 0)
+
+
+def test_full_status_replaces_the_state():
+    cache = LastValueCache()
+    cache.set("device", status(switch=True, temp_current=210))
+    cache.update("device", status(switch=False))
+    assert cache.get("device") == {"switch": False}
+
+
+def test_changes_against_the_stored_state():
+    cache = LastValueCache()
+    cache.set("device", status(switch=True, temp_current=210))
+    assert cache.changes("device", status(temp_current=210, switch=True)) == {}
+    assert cache.changes("device", status(switch=False, temp_current=210)) == {"switch": False}
+    assert cache.changes("unknown", status(switch=True)) == {"switch": True}
@@ -0,0 +1,31 @@
+import sys
+import os
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.device_registry import diff_devices
+
+EU = ("eu", "key", "secret")
+US = ("us", "other-key", "other-secret")
+
+
+def test_unchanged_devices():
+    assert diff_devices({"a": EU, "b": EU}, {"b": EU, "a": EU}) == ([], [])
+
+
+def test_added_and_removed_devices():
+    added, removed = diff_devices({"a": EU, "b": EU}, {"b": EU, "c": EU})
+    assert added == ["c"]
+    assert removed == ["a"]
+
+
+def test_device_moved_to_other_credentials_is_removed_and_added():
+    added, removed = diff_devices({"a": EU, "b": EU}, {"a": US, "b": EU})
+    assert added == ["a"]
+    assert removed == ["a"]
+
+
+def test_from_and_to_an_empty_registry():
+    assert diff_devices({}, {"a": EU}) == (["a"], [])
+    assert diff_devices({"a": EU}, {}) == ([], ["a"])
@@ -0,0 +1,44 @@
+import sys
+import os
+
+import pytest
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.downsample import lttb, parse_bucket
+
+
+def test_lttb_keeps_short_series():
+    points = [(0, 1), (1, 2), (2, 3)]
+    assert lttb(points, 10) == points
+
+
+def test_lttb_reduces_to_the_threshold_and_keeps_the_ends():
+    points = [(x, x % 7) for x in range(1000)]
+    sampled = lttb(points, 50)
+    assert len(sampled) == 50
+    assert sampled[0] == points[0]
+    assert sampled[-1] == points[-1]
+    assert [x for x, _ in sampled] == sorted(x for x, _ in sampled)
+    assert all(point in points for point in sampled)
+
+
+def test_lttb_keeps_a_spike():
+    points = [(x, 0) for x in range(100)]
+    points[42] = (42, 100)
+    assert (42, 100) in lttb(points, 10)
+
+
+def test_lttb_small_thresholds():
+    points = [(x, x) for x in range(10)]
+    assert lttb(points, 2) == [(0, 0), (9, 9)]
+    assert lttb(points, 1) == [(0, 0)]
+
+
+def test_parse_bucket():
+    assert parse_bucket("15m") == ("minute", 15)
+    assert parse_bucket("1d") == ("day", 1)
+    for bucket in ("", "0h", "1y", "h"):
+        with pytest.raises(ValueError):
+            parse_bucket(bucket)
@@ -0,0 +1,89 @@
+import json
+import sys
+import os
+import time
+
+import tinytuya
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.message_queue import LocalQueueTransport, TuyaMessageConsumer
+
+ACCESS_KEY = "0123456789abcdef0123456789abcdef"
+
+
+def encrypted_payload(report, access_key=ACCESS_KEY):
+    # What the Tuya message service sends: the report AES-ECB encrypted with characters 8-24 of the secret
+    cipher = tinytuya.AESCipher(access_key[8:24].encode())
+    data = cipher.encrypt(json.dumps(report).encode(), use_base64=True)
+    return json.dumps({"data": data.decode(), "t": 1700000000000, "protocol": 4}).encode()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+def start_consumer():
+    transport = LocalQueueTransport()
+    handled = []
+    consumer = TuyaMessageConsumer(transport, ACCESS_KEY, lambda device_id, status: handled.append((device_id, status)))
+    consumer.start()
+    return transport, consumer, handled
+
+
+def test_status_report_is_handled_and_acknowledged():
+    transport, consumer, handled = start_consumer()
+    try:
+        transport.publish(encrypted_payload({
+            "devId": "device-1",
+            "status": [{"code": "temp_current", "value": 215, "t": 1700000000000}]
+        }))
+        wait_for(lambda: consumer.stats()["handled"] == 1 and transport.queue.empty() and not transport.unacked)
+    finally:
+        consumer.stop()
+
+    assert handled == [("device-1", {
+        "result": [{"code": "temp_current", "value": 215}],
+        "success": True,
+        "t": 1700000000000
+    })]
+    assert consumer.stats() == {"received": 1, "handled": 1, "errors": 0}
+
+
+def test_undecodable_message_is_acknowledged_and_dropped():
+    transport, consumer, handled = start_consumer()
+    try:
+        transport.publish(b"not a tuya message")
+        transport.publish(encrypted_payload({"devId": "device-1", "status": []}, access_key="f" * 32))
+        wait_for(lambda: consumer.stats()["received"] == 2 and not transport.unacked)
+    finally:
+        consumer.stop()
+
+    assert handled == []
+    assert consumer.stats() == {"received": 2, "handled": 0, "errors": 2}
+
+
+def test_failed_handler_leaves_the_message_unacknowledged():
+    transport = LocalQueueTransport()
+
+    def handle_status(device_id, status):
+        raise RuntimeError("Mongo is down")
+
+    consumer = TuyaMessageConsumer(transport, ACCESS_KEY, handle_status)
+    consumer.start()
+    try:
+        message_id = transport.publish(encrypted_payload({
+            "devId": "device-1",
+            "status": [{"code": "switch", "value": True}]
+        }))
+        wait_for(lambda: consumer.stats()["errors"] == 1)
+    finally:
+        consumer.stop()
+
+    # Left for the broker to redeliver
+    assert message_id in transport.unacked
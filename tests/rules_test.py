@@ -0,0 +1,85 @@
+import sys
+import os
+
+import pytest
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.rules import Condition, RuleEngine
+
+
+def run(condition, readings):
+    return [condition.evaluate({"temp_current": reading}) for reading in readings]
+
+
+def test_condition_without_hysteresis_follows_the_threshold():
+    condition = Condition("sensor", "temp_current", ">", 25)
+    assert run(condition, [24, 26, 25, 26, 24.9]) == [False, True, False, True, False]
+
+
+def test_rising_condition_holds_until_past_the_hysteresis():
+    condition = Condition("sensor", "temp_current", ">", 25, hysteresis=2)
+    # Once on, it stays on until the value drops to 25 - 2
+    assert run(condition, [24, 26, 24, 23.5, 23, 24, 26]) == [False, True, True, True, False, False, True]
+
+
+def test_falling_condition_holds_until_past_the_hysteresis():
+    condition = Condition("sensor", "temp_current", "<", 10, hysteresis=1)
+    assert run(condition, [12, 9, 10, 10.9, 11, 10]) == [False, True, True, True, False, False]
+
+
+def test_missing_or_incomparable_value_is_false():
+    condition = Condition("sensor", "temp_current", ">", 25, hysteresis=2)
+    assert run(condition, [30]) == [True]
+    assert condition.evaluate({}) is False
+    assert run(condition, ["hot"]) == [False]
+
+
+def test_incomparable_value_while_holding_is_false():
+    condition = Condition("sensor", "temp_current", ">", 25, hysteresis=2)
+    assert run(condition, [30, "hot"]) == [True, False]
+
+
+def test_unknown_operator():
+    with pytest.raises(ValueError):
+        Condition("sensor", "temp_current", "~", 25)
+
+
+FAN_RULE = {
+    "name": "Fan on when warm",
+    "when": [{"device": "sensor", "code": "temp_current", "op": ">", "value": 25}],
+    "then": {"device": "fan", "commands": [{"code": "switch", "value": True}]},
+    "otherwise": {"device": "fan", "commands": [{"code": "switch", "value": False}]}
+}
+
+
+def sharded_engine(owned, values):
+    sent = []
+
+    def send_command(device_id, commands):
+        sent.append((device_id, commands["commands"][0]["value"]))
+        return True
+
+    engine = RuleEngine([FAN_RULE], send_command, lambda device_id: values.get(device_id), owns=owned.__contains__)
+    return engine, sent
+
+
+def test_rule_only_runs_on_the_node_owning_its_target():
+    values = {"sensor": {"temp_current": 30}, "fan": {"switch": False}}
+    engine, sent = sharded_engine({"sensor"}, values)
+    engine.on_change("sensor", {"temp_current": 30})
+    engine.tick()
+    engine.close()
+    assert sent == []
+    assert engine.evaluations == 0
+
+
+def test_target_owner_picks_up_remote_sensor_changes_on_tick():
+    values = {"sensor": {"temp_current": 30}, "fan": {"switch": False}}
+    engine, sent = sharded_engine({"fan"}, values)
+    engine.tick()
+    values["sensor"], values["fan"] = {"temp_current": 20}, {"switch": True}
+    engine.tick()
+    engine.close()
+    assert sent == [("fan", True), ("fan", False)]
@@ -0,0 +1,78 @@
+import sys
+import time
+import os
+
+# Add the project directory to the system path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.sharding import HashRing, ShardCoordinator
+
+DEVICES = [f"device-{i}" for i in range(2000)]
+
+
+def owners(ring):
+    return {device_id: ring.owner(device_id) for device_id in DEVICES}
+
+
+def test_empty_ring_has_no_owner():
+    assert HashRing().owner("device-1") is None
+
+
+def test_owner_is_stable_and_independent_of_node_order():
+    assert owners(HashRing(["a", "b", "c"])) == owners(HashRing(["c", "a", "b"]))
+
+
+def test_every_node_gets_a_share():
+    counts = {}
+    for owner in owners(HashRing(["a", "b", "c", "d"])).values():
+        counts[owner] = counts.get(owner, 0) + 1
+    assert set(counts) == {"a", "b", "c", "d"}
+    assert min(counts.values()) > len(DEVICES) / 4 / 2
+
+
+def test_adding_a_node_only_moves_keys_to_it():
+    before = owners(HashRing(["a", "b", "c"]))
+    after = owners(HashRing(["a", "b", "c", "d"]))
+    moved = [device_id for device_id in DEVICES if before[device_id] != after[device_id]]
+    assert all(after[device_id] == "d" for device_id in moved)
+    # About a quarter of the keys move, far from a full reshuffle
+    assert 0 < len(moved) < len(DEVICES) / 2
+
+
+def test_removing_a_node_only_moves_its_keys():
+    before = owners(HashRing(["a", "b", "c"]))
+    after = owners(HashRing(["a", "b"]))
+    for device_id in DEVICES:
+        if before[device_id] != "c":
+            assert after[device_id] == before[device_id]
+        else:
+            assert after[device_id] in ("a", "b")
+
+
+class FakeNodes:
+    def __init__(self, members):
+        self.members = members
+
+    def heartbeat_node(self, node_id, lease_ttl):
+        return self.members
+
+
+def test_node_releases_its_devices_once_the_lease_expires():
+    db_client = FakeNodes(["a", "b"])
+    coordinator = ShardCoordinator(db_client, node_id="a", lease_ttl=0.05)
+    assert coordinator.heartbeat()
+    owned = [device_id for device_id in DEVICES if coordinator.owns(device_id)]
+    assert owned
+
+    db_client.members = None
+    assert not coordinator.heartbeat()
+    assert all(coordinator.owns(device_id) for device_id in owned)
+
+    time.sleep(0.1)
+    assert not any(coordinator.owns(device_id) for device_id in owned)
+    assert coordinator.heartbeat()
+    assert not coordinator.heartbeat()
+
+    db_client.members = ["a", "b"]
+    assert coordinator.heartbeat()
+    assert all(coordinator.owns(device_id) for device_id in owned)
@@ -1,11 +1,10 @@
 import os
 import sys
-from fastapi import FastAPI, HTTPException
+import asyncio
+import signal
 import threading
-import time
-import requests
-import json
-import http.client
+from datetime import datetime
+from fastapi import FastAPI, HTTPException
 
 # Add the project directory to the system path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -14,6 +13,15 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config.settings import *
 from src.tuya_cloud_connect import TuyaDeviceManager
 from src.database import MongoDBClient
+from src.state_cache import last_values
+from src.change_detection import result_to_map, map_to_result, delta_status
+from src.message_queue import TuyaMessageConsumer, TuyaWebSocketTransport
+from src.forwarder import forwarder
+from src.poll_scheduler import PollScheduler
+from src.sharding import ShardCoordinator
+from src.rules import RuleEngine
+from src.metrics import change_detection_total, start_http_server
+from src.device_registry import DeviceRegistry, parse_devices, parse_projects, diff_devices
 
 # Set the environment variable
 ENV = os.getenv('ENV', 'development')
@@ -27,11 +35,13 @@ ENV = os.getenv('ENV', 'development')
 #     ENDPOINT_HOST = "localhost"
 
 API_URL = "https://dobroje.rs/parametri.php?action=tuyaDevicesList"
-ENDPOINT_HOST = "dobroje.rs"
 
-def is_data_changed(db_client, device_id, new_status):
+# Set in __main__ when RULES_ENABLED
+rule_engine = None
+
+def get_data_changes(db_client, device_id, new_status):
     """
-    Check if the new data differs from the latest data in the database.
+    Find the DPs of the new data that differ from the latest data in the database.
     
     Args:
     db_client: Database client instance.
@@ -39,104 +49,425 @@ def is_data_changed(db_client, device_id, new_status):
     new_status: New data from the sensor.
     
     Returns:
-    bool: True if data has changed, False otherwise.
+    dict: DP code -> new value for every changed DP, empty if nothing changed.
     """
     try:
-        latest_record = db_client.get_latest_record(device_id)
-        return latest_record['result'] != new_status['result']
+        if device_id not in last_values:
+            # Cold miss only: steady-state polls are answered from memory
+            last_values.set(device_id, db_client.get_latest_record(device_id))
+        return last_values.changes(device_id, new_status)
     except Exception as e:
         print(f"Error checking data change: {e}")
-        return True  # Assume data has changed if there's an error
+        return result_to_map(new_status.get('result'))  # Assume everything changed if there's an error
+
+def is_data_changed(db_client, device_id, new_status):
+    """
+    Check if the new data differs from the latest data in the database.
+    
+    Args:
+    db_client: Database client instance.
+    device_id: ID of the device.
+    new_status: New data from the sensor.
+    
+    Returns:
+    bool: True if data has changed, False otherwise.
+    """
+    return bool(get_data_changes(db_client, device_id, new_status))
 
 def send_data_to_endpoint(device_id, data):
     """
     Send data to a specific endpoint.
+    The sample is queued and posted by the shared forwarder, so this never blocks on the network.
     
     Args:
     device_id: ID of the device.
     data: Data to be sent.
     """
-    conn = http.client.HTTPConnection(ENDPOINT_HOST)
+    forwarder.submit(device_id, data)
 
-    payload = json.dumps({
-        "deviceID": device_id,
-        "data": data
-    })
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    print(f"Payload: {payload}")
-    try:
-        conn.request("POST", "/parametri.php?action=tuyapayload", payload, headers)
-        response = conn.getresponse()
-        
-        if response.status == 200:
-            print(f"Successfully sent data for device: {device_id}")
+# Per-device locks: polls and pushed reports of one device run on different threads, and each
+# reads, compares and updates the device's last values, so they must not interleave
+device_locks = {}
+device_locks_lock = threading.Lock()
+
+def device_lock(device_id):
+    with device_locks_lock:
+        lock = device_locks.get(device_id)
+        if lock is None:
+            # Reentrant, since a report is processed as a status under the same lock
+            lock = device_locks[device_id] = threading.RLock()
+        return lock
+
+def process_device_status(db_client, device_id, device_status):
+    """
+    Store and forward a freshly polled device status if it has changed.
+    
+    Args:
+    db_client: Database client instance.
+    device_id: ID of the device.
+    device_status: Status returned by the Tuya API.
+    
+    Returns:
+    bool: True if the data had changed, used by the scheduler to adapt the poll interval.
+    """
+    with device_lock(device_id):
+        # Check if the data has changed and update the database if it has
+        changes = get_data_changes(db_client, device_id, device_status)
+        if not changes:
+            change_detection_total.inc(result="unchanged")
+            return False
+        change_detection_total.inc(result="changed")
+
+        # In delta mode only the changed DPs are stored and forwarded, with a full keyframe now and then
+        if DELTA_ONLY_CHANGES and not last_values.keyframe_due(device_id, DELTA_KEYFRAME_INTERVAL):
+            stored_status = delta_status(device_status, changes)
+            last_values.update(device_id, stored_status)
         else:
-            print(f"Failed to send data for device: {device_id}, status code: {response.status}")
-            response_content = response.read().decode()
-            print(response_content)
-            
+            stored_status = device_status
+            last_values.set(device_id, stored_status)
+
+        db_client.insert_data(device_id, stored_status)
+    print(f"Inserted new data for device: {device_id}: {stored_status}")
+    send_data_to_endpoint(device_id, stored_status)
+    if rule_engine is not None:
+        rule_engine.on_change(device_id, changes)
+    return True
+
+def process_device_report(db_client, device_id, report_status):
+    """
+    Feed a status report pushed by the Tuya message service through the same pipeline as a polled status.
+    Reports only carry the DPs that changed, so they are merged onto the last known state first.
+    
+    Args:
+    db_client: Database client instance.
+    device_id: ID of the device.
+    report_status: Partial status decoded from the message.
+    
+    Returns:
+    bool: True if the data had changed.
+    """
+    with device_lock(device_id):
+        if device_id not in last_values:
+            last_values.set(device_id, db_client.get_latest_record(device_id))
+        values = last_values.get(device_id) or {}
+        values.update(result_to_map(report_status['result']))
+        return process_device_status(db_client, device_id, dict(report_status, result=map_to_result(values)))
+
+def start_message_consumers(db_client, scheduler, projects):
+    """
+    Start one Tuya message service consumer per project. Devices that push reports
+    are then only polled every MQ_RECONCILE_INTERVAL seconds.
+    
+    Args:
+    db_client: Database client instance.
+    scheduler: Running PollScheduler instance.
+    projects: (api_region, api_key, api_secret) of every project.
+    
+    Returns:
+    list: The started consumers.
+    """
+    def handle_status(device_id, report_status):
+        if device_id not in scheduler.devices:
+            return
+        process_device_report(db_client, device_id, report_status)
+        scheduler.call_soon(scheduler.use_push, device_id)
+
+    consumers = []
+    for api_region, api_key, api_secret in projects:
+        try:
+            transport = TuyaWebSocketTransport(api_region, api_key, api_secret)
+        except Exception as e:
+            print(f"Can't start message consumer for {api_key}: {e}")
+            continue
+        consumer = TuyaMessageConsumer(transport, api_secret, handle_status)
+        consumer.start()
+        consumers.append(consumer)
+    return consumers
+
+def fetch_device_categories(device_manager):
+    """
+    Look up the Tuya category of every device visible to a project, used for per-category poll intervals.
+    
+    Args:
+    device_manager: Any device instance holding the project's credentials.
+    
+    Returns:
+    dict: Device ID -> category code.
+    """
+    try:
+        devices = device_manager.cloud_call('getdevices', verbose=False, coalesce=True)
+        return {device['id']: device.get('category') for device in devices}
     except Exception as e:
-        print(f"Error sending data to endpoint: {e}")
+        print(f"Error fetching device categories: {e}")
+        return {}
+
+def current_values(db_client, scheduler, device_id):
+    """
+    Current DP values of a device for rule evaluation: from memory for devices this node polls,
+    from the database for the others (e.g. devices owned by another shard).
+    """
+    if device_id in scheduler.devices and device_id in last_values:
+        return last_values.get(device_id)
+    return db_client.get_latest_results(device_id)
+
+def send_rule_command(db_client, registry, device_id, commands):
+    """
+    Send a command issued by a rule and record it, so the target is polled again soon.
+    
+    Returns:
+    bool: True if the device accepted the command.
+    """
+    entry = registry.get(device_id)
+    if entry is None:
+        print(f"Rule target {device_id} is not a registered device")
+        return False
+    if not entry[0].send_command(commands):
+        return False
+    db_client.record_command_event(device_id, commands)
+    return True
+
+async def run_rule_timer():
+    """
+    Periodically re-check the rules with a time window or with sensors polled by another shard.
+    """
+    while True:
+        await asyncio.sleep(RULES_TIMER_INTERVAL)
+        try:
+            await asyncio.to_thread(rule_engine.tick)
+        except Exception as e:
+            print(f"Error checking timed rules: {e}")
+
+def load_devices(devices, device_ids):
+    """
+    Create the device managers of the given devices and look up their categories, one call per project.
+    
+    Args:
+    devices: Device ID -> (credentials, device name), as returned by parse_devices().
+    device_ids: IDs of the devices to load.
+    
+    Returns:
+    dict: Device ID -> (device manager, category).
+    """
+    project_devices = {}
+    for device_id in device_ids:
+        credentials, device_name = devices[device_id]
+        print(f"Device Name: {device_name}, Device ID: {device_id}")
+        project_devices.setdefault(credentials, []).append(TuyaDeviceManager(*credentials, device_id))
+
+    entries = {}
+    for device_managers in project_devices.values():
+        categories = fetch_device_categories(device_managers[0])
+        for device_manager in device_managers:
+            entries[device_manager.device_id] = (device_manager, categories.get(device_manager.device_id))
+    return entries
+
+def sync_scheduled_devices(scheduler, registry, coordinator=None):
+    """
+    Make the scheduler poll exactly the registered devices this node owns, each with its registered manager.
+    Must be called from the scheduler's event loop once it is running.
+    
+    Args:
+    scheduler: PollScheduler instance.
+    registry: Device ID -> (device manager, category) of every known device.
+    coordinator: ShardCoordinator in sharding mode, None to poll every device.
+    
+    Returns:
+    tuple: (added, removed) device counts.
+    """
+    owned = {
+        device_id for device_id in registry
+        if coordinator is None or coordinator.owns(device_id)
+    }
+    # A device whose registry entry was replaced (e.g. it moved to other credentials) is re-added with the new manager
+    removed = [
+        device_id for device_id, device in scheduler.devices.items()
+        if device_id not in owned or device.manager is not registry[device_id][0]
+    ]
+    for device_id in removed:
+        scheduler.remove_device(device_id)
+    # Other nodes store the devices this node doesn't own, so their cached state goes stale:
+    # drop it, and a device taken over later is read from Mongo again before its first comparison
+    for device_id in registry:
+        if device_id not in owned:
+            last_values.discard(device_id)
+    added = [device_id for device_id in owned if device_id not in scheduler.devices]
+    for device_id in added:
+        device_manager, category = registry[device_id]
+        scheduler.add_device(device_manager, category=category)
+    return len(added), len(removed)
+
+async def run_shard_coordinator(coordinator, scheduler, registry):
+    """
+    Renew this node's lease and rebalance the polled devices whenever the fleet membership changes,
+    or drop them all while the lease is expired.
+    
+    Args:
+    coordinator: ShardCoordinator instance.
+    scheduler: Running PollScheduler instance.
+    registry: Device ID -> (device manager, category) of every known device.
+    """
+    try:
+        while True:
+            await asyncio.sleep(SHARD_HEARTBEAT_INTERVAL)
+            try:
+                if await asyncio.to_thread(coordinator.heartbeat):
+                    added, removed = sync_scheduled_devices(scheduler, registry, coordinator)
+                    print(f"Rebalanced shard: +{added} -{removed} devices, polling {len(scheduler.devices)}")
+            except Exception as e:
+                print(f"Error in shard heartbeat: {e}")
     finally:
-        conn.close()
+        await asyncio.to_thread(coordinator.leave)
 
-def database_update(db_client, device):
+async def refresh_device_registry(device_registry, scheduler, registry, projects, coordinator=None):
     """
-    Continuously update the database with new device data if it has changed.
+    Periodically re-fetch the device list and hot-add/remove only the devices that changed.
+    Unchanged devices keep their managers, sessions and place in the schedule.
+    
+    Args:
+    device_registry: DeviceRegistry instance.
+    scheduler: Running PollScheduler instance.
+    registry: Device ID -> (device manager, category), updated in place.
+    projects: (api_region, api_key, api_secret) of every project, updated in place.
+    coordinator: ShardCoordinator in sharding mode, None to poll every device.
+    """
+    while True:
+        try:
+            devices_data = await asyncio.to_thread(device_registry.fetch)
+            if devices_data is not None:
+                devices = parse_devices(devices_data)
+                added, removed = diff_devices(
+                    {device_id: entry[0].credentials for device_id, entry in registry.items()},
+                    {device_id: credentials for device_id, (credentials, _) in devices.items()}
+                )
+                entries = await asyncio.to_thread(load_devices, devices, added) if added else {}
+                for device_id in removed:
+                    registry.pop(device_id, None)
+                registry.update(entries)
+                projects[:] = parse_projects(devices_data)
+                if added or removed:
+                    scheduled, unscheduled = sync_scheduled_devices(scheduler, registry, coordinator)
+                    print(f"Device registry changed: {len(added)} added, {len(removed)} removed, "
+                          f"polling +{scheduled} -{unscheduled} devices")
+        except Exception as e:
+            print(f"Error refreshing device registry: {e}")
+        await asyncio.sleep(REGISTRY_REFRESH_INTERVAL)
+
+async def watch_command_events(db_client, scheduler):
+    """
+    Tighten the poll interval of devices that were just sent a command through the API.
     
     Args:
     db_client: Database client instance.
-    device: Device instance.
+    scheduler: Running PollScheduler instance.
     """
+    since = datetime.now()
     while True:
+        await asyncio.sleep(COMMAND_EVENTS_POLL_INTERVAL)
         try:
-            # Retrieve status from the sensors
-            device_status = device.get_status()
-            # Check if the luminance data has changed and update the database if it has
-            if is_data_changed(db_client, device.device_id, device_status):
-                db_client.insert_data(device.device_id, device_status)
-                print(f"Inserted new data for device: {device.device_id}: {device_status}")
-                send_data_to_endpoint(device.device_id, device_status)
+            events = await asyncio.to_thread(db_client.get_command_events, since)
+            for event in events:
+                since = max(since, event['timestamp'])
+                scheduler.notify_command(event['device_name'])
+        except Exception as e:
+            print(f"Error checking command events: {e}")
 
-            # Wait for 1 second before the next iteration
-            time.sleep(1)
+async def run_poller(db_client, scheduler, projects=(), registry=None, coordinator=None, device_registry=None):
+    """
+    Run the poll scheduler until SIGINT/SIGTERM, then shut it down gracefully.
+    
+    Args:
+    db_client: Database client instance.
+    scheduler: PollScheduler instance.
+    projects: (api_region, api_key, api_secret) of every project, for push ingestion.
+    registry: Device ID -> (device manager, category) of every known device.
+    coordinator: ShardCoordinator in sharding mode, None to poll every device.
+    device_registry: DeviceRegistry to keep the devices up to date from, None for a fixed device list.
+    """
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, scheduler.stop)
+    sync_scheduled_devices(scheduler, registry or {}, coordinator)
+    tasks = [asyncio.create_task(watch_command_events(db_client, scheduler))]
+    if coordinator is not None:
+        tasks.append(asyncio.create_task(run_shard_coordinator(coordinator, scheduler, registry or {})))
+    if rule_engine is not None and rule_engine.has_timer():
+        tasks.append(asyncio.create_task(run_rule_timer()))
+    if device_registry is not None:
+        tasks.append(asyncio.create_task(
+            refresh_device_registry(device_registry, scheduler, registry, projects, coordinator)
+        ))
 
-        except Exception as e:
-            print(f"Error in database update: {e}")
+    consumers = []
+    if MQ_ENABLED and coordinator is not None:
+        # A project's message stream isn't split by device, a node would drop reports of devices it doesn't own
+        print("Push ingestion is not supported in sharding mode, polling only")
+    elif MQ_ENABLED:
+        consumers = start_message_consumers(db_client, scheduler, projects)
+    try:
+        await scheduler.run()
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Let the coordinator give up its lease
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for consumer in consumers:
+            await asyncio.to_thread(consumer.stop)
 
 if __name__ == "__main__":
-    import uvicorn
-    
+    if METRICS_ENABLED:
+        try:
+            start_http_server(METRICS_PORT)
+            print(f"Serving metrics on port {METRICS_PORT}")
+        except OSError as e:
+            # e.g. a second updater on the same host; polling matters more than its metrics
+            print(f"Not serving metrics, can't bind port {METRICS_PORT}: {e}")
+
     db_client = MongoDBClient()
-    response = requests.get(API_URL)
-    if response.status_code != 200:
-        raise HTTPException(status_code=response.status_code, detail="Failed to fetch devices")
+    last_values.warm(db_client)
 
-    devices_data = response.json()
+    # Start from the local snapshot if there is one; the refresher catches up with the remote list
+    device_registry = DeviceRegistry(API_URL)
+    devices_data = device_registry.load_snapshot()
+    if devices_data is not None:
+        print(f"Loaded device registry snapshot from {device_registry.snapshot_path}")
+    else:
+        try:
+            devices_data = device_registry.fetch()
+        except Exception as e:
+            raise HTTPException(status_code=502, detail=str(e))
 
-    devices = []
+    scheduler = PollScheduler(
+        lambda device_id, device_status: process_device_status(db_client, device_id, device_status)
+    )
 
-    # Iterate over each project
-    for project in devices_data.get("projects", []):
-        api_region = project.get("api_region")
-        api_key = project.get("api_key")
-        api_secret = project.get("api_secret")
+    projects = parse_projects(devices_data)
+    for api_region, api_key, api_secret in projects:
         print(f"API Region: {api_region}, API Key: {api_key}, API Secret: {api_secret}")
+    devices = parse_devices(devices_data)
+    registry = load_devices(devices, devices)
+
+    # In sharding mode this instance only polls the devices that hash to it
+    coordinator = None
+    if SHARDING_ENABLED:
+        coordinator = ShardCoordinator(db_client)
+        coordinator.heartbeat()
+        print(f"Shard node {coordinator.node_id} joined a fleet of {len(coordinator.ring.nodes)}")
 
-        for device_name, device_id in project.get("devices", {}).items():
-            print(f"Device Name: {device_name}, Device ID: {device_id}")
-            device_manager = TuyaDeviceManager(api_region, api_key, api_secret, device_id)
-            devices.append(device_manager)
-
-    # Create threads for concurrent execution of database update for each device
-    threads = []
-    for device in devices:
-        thread = threading.Thread(target=database_update, args=(db_client, device))
-        threads.append(thread)
-        thread.start()
-
-    # Join threads to ensure the main program waits for them to finish
-    for thread in threads:
-        thread.join()
+    if RULES_ENABLED:
+        rule_engine = RuleEngine(
+            RULES,
+            lambda device_id, commands: send_rule_command(db_client, registry, device_id, commands),
+            lambda device_id: current_values(db_client, scheduler, device_id),
+            # Each rule runs on the node owning its target, sensors of other nodes are read from the database
+            owns=coordinator.owns if coordinator is not None else None
+        )
+        print(f"Loaded {len(rule_engine.rules)} rules on {len(rule_engine.index)} DPs")
+
+    # One event loop drives every device; Ctrl+C / SIGTERM stops it cleanly
+    try:
+        asyncio.run(run_poller(db_client, scheduler, projects, registry, coordinator, device_registry))
+    finally:
+        if rule_engine is not None:
+            rule_engine.close()
+        forwarder.close()
+        db_client.close()